@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Micro-benchmarks for the performance sensitive parts of the bot.
+# Every benchmark is a subcommand, e.g.
+#   python3 benchmark.py planner --horizons 4 8 16 --candidates 64 256
+#####################################################################
+
+import argparse
+import sys
+import time
+import numpy as np
+
+
+"""
+ret: (seconds of the first call, mean seconds of the following calls)
+"""
+def time_function(function, n_repeats):
+    t_begin = time.perf_counter()
+    function()
+    t_first = time.perf_counter() - t_begin
+
+    t_begin = time.perf_counter()
+    for i in range(n_repeats):
+        function()
+    return t_first, (time.perf_counter() - t_begin) / n_repeats
+
+
+def create_model(replay_sample_length=256, **kwargs):
+    from model import Model
+    return Model(episode_length=1024, n_replay_episodes=8, n_training_epochs=1,
+        replay_sample_length=replay_sample_length, **kwargs)
+
+
+def benchmark_planner(args):
+    import tensorflow as tf
+    from planner import Planner
+
+    model = create_model()
+    model.image_enc = tf.random.uniform((1, model.image_enc_size), -1.0, 1.0)
+    model.state = tf.random.uniform((1, model.state_size), -1.0, 1.0)
+
+    print("{:>8} {:>8} {:>10} {:>12} {:>12}".format(
+        "method", "horizon", "candidates", "trace (s)", "step (ms)"))
+    for horizon in args.horizons:
+        for n_candidates in args.candidates:
+            planner = Planner(model, horizon=horizon, n_candidates=n_candidates,
+                method=args.method)
+            t_first, t_step = time_function(planner, args.repeats)
+            print("{:>8} {:8d} {:10d} {:12.3f} {:12.3f}".format(
+                args.method, horizon, n_candidates, t_first, t_step*1000.0))
+
+
+"""
+Step loop throughput with the old per-step console line vs. the rate-limited reporter
+
+Only the reporting is exercised (no game or model), so the difference is the pure terminal
+I/O and formatting overhead per step.
+"""
+def benchmark_reporter(args):
+    from progress import ProgressReporter
+
+    rng = np.random.default_rng(0)
+    actions = rng.uniform(-1.0, 1.0, (1024, 15))
+    rewards = rng.normal(size=1024)
+
+    def loop_print():
+        for i in range(args.steps):
+            action = actions[i % 1024]
+            action_print = np.where(action>0.0, 1, 0)
+            print("{} {:8.3f} | r: {:3.8f} e: {:2.8f}".format(
+                action_print[0:14], action[14]*10.0, rewards[i % 1024], 0.5), end="\r")
+
+    def loop_reporter(rate_hz):
+        reporter = ProgressReporter("Benchmark", rate_hz=rate_hz)
+        for i in range(args.steps):
+            action = actions[i % 1024]
+            reporter.update(r=rewards[i % 1024])
+        reporter.close()
+
+    results = []
+    for name, function in (("print every step", loop_print),
+        ("reporter {} Hz".format(args.rate_hz), lambda: loop_reporter(args.rate_hz)),
+        ("reporter disabled", lambda: loop_reporter(0.0))):
+        t_begin = time.perf_counter()
+        function()
+        results.append((name, args.steps / (time.perf_counter() - t_begin)))
+
+    print("")
+    for name, steps_per_second in results:
+        print("{:>24}: {:12.0f} steps/s".format(name, steps_per_second), file=sys.stderr)
+
+
+"""
+Encoding a replay memory one time step at a time vs. in chunks of time steps x episodes
+"""
+def benchmark_encoding(args):
+    import tensorflow as tf
+
+    model = create_model()
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (args.steps, 8, 240, 320, 4), dtype=np.uint8)
+
+    def encode_per_step():
+        for i in range(args.steps):
+            model.model_image_encoder(
+                tf.convert_to_tensor(images[i], dtype=tf.float32) * 0.0039215686274509803,
+                training=False)
+
+    print("{:>12} {:>12} {:>14}".format("chunk size", "first (s)", "frames/s"))
+    t_first, t = time_function(encode_per_step, args.repeats)
+    print("{:>12} {:12.3f} {:14.1f}".format("per step", t_first, images.shape[0]*8 / t))
+    for chunk_size in args.chunk_sizes:
+        t_first, t = time_function(lambda: model.encode_images(images, chunk_size),
+            args.repeats)
+        print("{:12d} {:12.3f} {:14.1f}".format(chunk_size, t_first, images.shape[0]*8 / t))
+
+
+"""
+Frames per second of the collection loop, serial vs. pipelined engine and inference
+"""
+def benchmark_pipeline(args):
+    from init_game import init_game
+    from progress import ProgressReporter
+    from reward import Reward
+    from trainer_interface import TrainerInterface
+    from utils import get_player_pos
+
+    game = init_game(args.episode_length, False)
+    game.new_episode()
+    model = create_model()
+
+    print("{:>8} {:>12}".format("latency", "frames/s"))
+    for action_latency in args.latencies:
+        # latent memory, so that no frames are kept
+        trainer = TrainerInterface(model, Reward(get_player_pos(game)), 8,
+            args.episode_length, 0, False, memory_latent="float16",
+            action_latency=action_latency,
+            reporter=ProgressReporter(rate_hz=0.0))
+        trainer.memory = trainer.create_memory()
+
+        n_frames = 0
+        t_begin = time.perf_counter()
+        while n_frames < args.steps:
+            game.new_episode()
+            game.send_game_command('am_scale 0.5')
+            trainer.episode_reset()
+            trainer.memory.begin_episode()
+            while not game.is_episode_finished() and n_frames < args.steps:
+                if trainer.step(game, n_frames):
+                    trainer.memory = trainer.create_memory()
+                n_frames += 1
+        print("{:8d} {:12.1f}".format(action_latency, n_frames / (time.perf_counter() - t_begin)))
+
+    game.close()
+
+
+"""
+Compile time and step time of every training phase and of the per-step inference, with and
+without XLA
+"""
+def benchmark_xla(args):
+    import tensorflow as tf
+
+    length = args.sample_length
+    rng = np.random.default_rng(0)
+    images = tf.constant(rng.random((length, 8, 240, 320, 4), dtype=np.float32))
+    image_encs = tf.constant(rng.uniform(-1.0, 1.0, (length, 8, 256)).astype(np.float32))
+    actions = tf.constant(rng.uniform(-1.0, 1.0, (length, 8, 15)).astype(np.float32))
+    rewards = tf.constant(rng.normal(size=(length, 8)).astype(np.float32))
+    masks = tf.ones((length, 8))
+    state = tf.zeros((8, 256))
+    i = tf.constant(0)
+    frame = rng.integers(0, 256, (240, 320, 4), dtype=np.uint8)
+
+    print("{:>6} {:>24} {:>12} {:>12}".format("xla", "phase", "compile (s)", "step (ms)"))
+    for jit_compile in (False, True):
+        model = create_model(replay_sample_length=length, jit_compile=jit_compile)
+        model.select_training_functions()
+        phases = [
+            ("image encoder", lambda: model.train_image_encoder_model(images, actions, rewards,
+                state, masks, i)),
+            ("backbone", lambda: model.train_backbone(image_encs, actions, rewards, state, masks,
+                i)),
+            ("action model", lambda: model.models_action[0].train(image_encs, actions, rewards,
+                state, masks, i, tf.constant(0.98))),
+            ("advance (inference)", lambda: model.advance(frame, np.zeros(15))),
+        ]
+        for name, function in phases:
+            t_first, t_step = time_function(function, args.repeats)
+            print("{:>6} {:>24} {:12.3f} {:12.3f}".format(str(jit_compile), name,
+                t_first - t_step, t_step*1000.0))
+
+
+"""
+Time per training epoch vs. the mean training losses for window strides and shared windows
+
+All configurations start from the same weights and train on the same replay sample, from a
+dataset (see dataset.py) or random. The losses are the means of the last epoch, the steps are
+the training steps (launches) of the backbone phase per epoch.
+"""
+def benchmark_windows(args):
+    import tensorflow as tf
+    from progress import ProgressReporter
+
+    length = args.sample_length
+    if args.dataset_dir is not None:
+        from dataset import EpisodeDataset
+        from memory import mix_reward_simple
+        dataset = EpisodeDataset(args.dataset_dir)
+        memory = next(dataset.memories(8,
+            mix_reward=mix_reward_simple if dataset.defer_curiosity else None))
+        if memory.latent is None:
+            frames, image_encs_stored = memory.get_frames(0, length), None
+        else:
+            frames, image_encs_stored = None, memory.get_image_encs(0, length)
+        actions, rewards, masks = (memory.actions[:length], memory.rewards_discounted[:length],
+            memory.masks[:length])
+    else:
+        rng = np.random.default_rng(0)
+        frames, image_encs_stored = rng.integers(0, 256, (length, 8, 240, 320, 4),
+            dtype=np.uint8), None
+        actions = rng.uniform(-1.0, 1.0, (length, 8, 15)).astype(np.float32)
+        rewards = rng.normal(size=(length, 8)).astype(np.float32)
+        masks = np.ones((length, 8), dtype=np.float32)
+    actions, rewards, masks = (tf.constant(x, dtype=tf.float32) for x in (actions, rewards, masks))
+    # the sample starts at the beginning of the episodes
+    state = tf.zeros((8, 256))
+    images = None
+    if args.encoder and frames is not None:
+        images = tf.constant(frames, dtype=tf.float32) * 0.0039215686274509803
+
+    print("{:>6} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stride",
+        "shared", "steps", "epoch (s)", "l_i", "l_t", "l_r", "l_e", "l_action"))
+    for stride in args.strides:
+        for shared_windows in args.shared_windows:
+            tf.random.set_seed(0)
+            model = create_model(replay_sample_length=length, window_stride_encoder=stride,
+                window_stride_backbone=stride, window_stride_action=stride,
+                shared_windows=shared_windows)
+            model.reporter = ProgressReporter(rate_hz=0.0)
+            model.select_training_functions()
+            image_encs = tf.Variable(model.encode_images(frames) if frames is not None else
+                image_encs_stored)
+
+            # the first epoch includes the tracing
+            for e in range(args.epochs + 1):
+                t_begin = time.perf_counter()
+                loss_inverse = float("nan")
+                if images is not None:
+                    model.train_encoder_phase(e, images, actions, rewards, state, masks)
+                    loss_inverse = model.reporter.mean("l_i")
+                discount_mean = model.train_backbone_phase(e, image_encs, actions, rewards,
+                    state, masks)
+                losses = [model.reporter.mean(name) for name in ("l_t", "l_r", "l_e")]
+                model.train_action_phase(e, 0, image_encs, actions, rewards, state, masks,
+                    np.math.exp(-1.0/discount_mean))
+                t_epoch = time.perf_counter() - t_begin
+            n_steps = len(model.window_starts(model.tbptt_length_backbone, stride))
+            print("{:6d} {:6d} {:6d} {:10.2f} {:10.5f} {:10.5f} {:10.5f} {:10.5f} {:10.5f}".format(
+                stride, shared_windows, n_steps, t_epoch, loss_inverse, *losses,
+                model.reporter.mean("l_t")))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_planner = subparsers.add_parser("planner",
+        help="latency of the model-predictive planner per horizon and candidate count")
+    parser_planner.add_argument('--method', type=str, choices=["cem", "shooting"], default="cem")
+    parser_planner.add_argument('--horizons', type=int, nargs="+", default=[4, 8, 16])
+    parser_planner.add_argument('--candidates', type=int, nargs="+", default=[64, 256, 1024])
+    parser_planner.add_argument('--repeats', type=int, default=20)
+    parser_planner.set_defaults(function=benchmark_planner)
+
+    parser_reporter = subparsers.add_parser("reporter",
+        help="step throughput with per-step printing vs. the rate-limited reporter")
+    parser_reporter.add_argument('--steps', type=int, default=100000)
+    parser_reporter.add_argument('--rate_hz', type=float, default=4.0)
+    parser_reporter.set_defaults(function=benchmark_reporter)
+
+    parser_encoding = subparsers.add_parser("encoding",
+        help="image encoder throughput per time step vs. chunked over time steps and episodes")
+    parser_encoding.add_argument('--steps', type=int, default=128)
+    parser_encoding.add_argument('--chunk_sizes', type=int, nargs="+", default=[64, 256, 512])
+    parser_encoding.add_argument('--repeats', type=int, default=3)
+    parser_encoding.set_defaults(function=benchmark_encoding)
+
+    parser_pipeline = subparsers.add_parser("pipeline",
+        help="collection frames/s with and without overlapping engine and inference")
+    parser_pipeline.add_argument('--steps', type=int, default=2048)
+    parser_pipeline.add_argument('--episode_length', type=int, default=1024)
+    parser_pipeline.add_argument('--latencies', type=int, nargs="+", default=[0, 1])
+    parser_pipeline.set_defaults(function=benchmark_pipeline)
+
+    parser_xla = subparsers.add_parser("xla",
+        help="compile and step time of the training phases and the inference with/without XLA")
+    parser_xla.add_argument('--sample_length', type=int, default=40,
+        help="replay window length, at least the backbone unroll length (32)")
+    parser_xla.add_argument('--repeats', type=int, default=10)
+    parser_xla.set_defaults(function=benchmark_xla)
+
+    parser_windows = subparsers.add_parser("windows",
+        help="epoch time vs. training losses per window stride and number of shared windows")
+    parser_windows.add_argument('--strides', type=int, nargs="+", default=[1, 2, 4])
+    parser_windows.add_argument('--shared_windows', type=int, nargs="+", default=[1, 4])
+    parser_windows.add_argument('--sample_length', type=int, default=96)
+    parser_windows.add_argument('--epochs', type=int, default=2)
+    parser_windows.add_argument('--encoder', action='store_true',
+        help="include the image encoder phase (needs frames)")
+    parser_windows.add_argument('--dataset_dir', type=str, default=None,
+        help="train on a replay sample from this dataset instead of random data")
+    parser_windows.set_defaults(function=benchmark_windows)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import numpy as np
+import os
+import queue
+import random
+import re
+import threading
+
+
+# bump when the layout of the stored arrays changes
+# 2: optimizer state as a tf.train.Checkpoint instead of per-slot arrays
+# 3: per-slot arrays again (the layout of 1), the optimizer state of 2 is not restored
+CHECKPOINT_FORMAT_VERSION = 3
+
+checkpoint_filename_pattern = re.compile(r"^ckpt-(\d+)\.npz$")
+
+
+def checkpoint_filename(version):
+    return "ckpt-{:08d}.npz".format(version)
+
+
+"""
+ret: list of (version, path) sorted by version, oldest first
+"""
+def list_checkpoints(directory):
+    if not os.path.isdir(directory):
+        return []
+
+    checkpoints = []
+    for filename in os.listdir(directory):
+        match = checkpoint_filename_pattern.match(filename)
+        if match is not None:
+            checkpoints.append((int(match.group(1)), os.path.join(directory, filename)))
+    return sorted(checkpoints)
+
+
+"""
+Write a checkpoint (dict of name -> numpy array) into a single file
+
+The data is written into a temporary file first and renamed over the target, so a crash
+mid-save never leaves a torn checkpoint behind.
+"""
+def write_checkpoint(path, state, version):
+    path_tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(path_tmp, "wb") as f:
+        np.savez(f, __format_version__=np.array(CHECKPOINT_FORMAT_VERSION),
+            __version__=np.array(version), **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path)
+
+    # make the rename itself durable
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def load_checkpoint(path):
+    with np.load(path, allow_pickle=False) as data:
+        format_version = int(data["__format_version__"])
+        # older formats are still loaded, entries that are not understood anymore are skipped
+        if format_version > CHECKPOINT_FORMAT_VERSION:
+            raise ValueError("Unsupported checkpoint format version {} in {} (supported up to "
+                "{})".format(format_version, path, CHECKPOINT_FORMAT_VERSION))
+        return {key: data[key] for key in data.files if not key.startswith("__")}
+
+
+"""
+Fast resume path: load the newest checkpoint in the directory
+
+ret: (version, state) or None if there are no checkpoints
+"""
+def load_latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    if len(checkpoints) == 0:
+        return None
+    version, path = checkpoints[-1]
+    print("Loading checkpoint {}".format(path))
+    return version, load_checkpoint(path)
+
+
+class CheckpointWriter:
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        checkpoints = list_checkpoints(directory)
+        self.version = checkpoints[-1][0] if len(checkpoints) > 0 else 0
+
+        # at most one snapshot waits while another one is being written
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, name="checkpoint_writer", daemon=True)
+        self.thread.start()
+
+    """
+    Queue a snapshot for writing
+
+    The state must already be a copy (numpy arrays), the training thread is free to keep
+    updating the weights as soon as this returns.
+    """
+    def save(self, state):
+        self.version += 1
+        self.queue.put((self.version, state))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            version, state = item
+            path = os.path.join(self.directory, checkpoint_filename(version))
+            try:
+                write_checkpoint(path, state, version)
+                self.remove_old_checkpoints()
+            except OSError as e:
+                # keep training, the next snapshot gets another chance
+                print("Writing checkpoint {} failed: {}".format(path, e))
+            finally:
+                self.queue.task_done()
+
+    def remove_old_checkpoints(self):
+        checkpoints = list_checkpoints(self.directory)
+        for version, path in checkpoints[:max(len(checkpoints) - self.keep, 0)]:
+            os.remove(path)
+
+    # block until all queued snapshots are on disk
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+"""
+Snapshot of the global python and numpy random generators as checkpoint entries
+"""
+def get_rng_state():
+    python_version, python_internal, python_gauss_next = random.getstate()
+    numpy_name, numpy_keys, numpy_pos, numpy_has_gauss, numpy_cached_gaussian =\
+        np.random.get_state()
+    return {
+        "rng/python_version": np.array(python_version),
+        "rng/python_internal": np.array(python_internal, dtype=np.int64),
+        # gauss_next is None unless random.gauss has a cached value
+        "rng/python_gauss_next": np.array([] if python_gauss_next is None else [python_gauss_next],
+            dtype=np.float64),
+        "rng/numpy_keys": numpy_keys,
+        "rng/numpy_pos": np.array(numpy_pos),
+        "rng/numpy_has_gauss": np.array(numpy_has_gauss),
+        "rng/numpy_cached_gaussian": np.array(numpy_cached_gaussian),
+    }
+
+
+def set_rng_state(state):
+    if "rng/python_internal" in state:
+        gauss_next = state["rng/python_gauss_next"]
+        random.setstate((int(state["rng/python_version"]),
+            tuple(int(x) for x in state["rng/python_internal"]),
+            float(gauss_next[0]) if len(gauss_next) > 0 else None))
+    if "rng/numpy_keys" in state:
+        np.random.set_state(("MT19937", state["rng/numpy_keys"],
+            int(state["rng/numpy_pos"]), int(state["rng/numpy_has_gauss"]),
+            float(state["rng/numpy_cached_gaussian"])))
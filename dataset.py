@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Sharded on-disk episode dataset for offline training. Every full
+# replay memory collected by the trainer is appended as one .npz shard
+# (frames or image encodings, actions, rewards, masks, episode lengths
+# and maps), index.json lists the shards. The reader streams shuffled
+# episodes through tf.data and turns them into Memory batches for
+# Model.train, or into frame batches for autoencoder pretraining. With
+# deferred curiosity the stored rewards leave out the curiosity reward,
+# the reader mixes it back in with the reward mixing of the trainer.
+#
+#   python3 main.py --dataset_dir data/episodes        # record while training
+#   python3 dataset.py --dataset_dir data/episodes --cycles 64
+#####################################################################
+
+import argparse
+import json
+import os
+import numpy as np
+
+from memory import Memory, mix_reward_simple
+
+
+DATASET_FORMAT_VERSION = 1
+
+
+def index_path(directory):
+    return os.path.join(directory, "index.json")
+
+
+"""
+ret: index dict of the dataset in directory, None if there is none
+"""
+def load_index(directory):
+    if not os.path.exists(index_path(directory)):
+        return None
+    with open(index_path(directory)) as f:
+        index = json.load(f)
+    if index["version"] > DATASET_FORMAT_VERSION:
+        raise ValueError("Dataset format version {} is newer than the supported {}".format(
+            index["version"], DATASET_FORMAT_VERSION))
+    return index
+
+
+def write_atomically(path, write):
+    path_tmp = path + ".tmp"
+    with open(path_tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path)
+
+
+class DatasetWriter:
+    """
+    Appends replay memories to the dataset in directory as shards
+
+    compress: np.savez_compressed, smaller but much slower to write and read
+    """
+    def __init__(self, directory, compress=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compress = compress
+        self.index = load_index(directory)
+        if self.index is None:
+            self.index = {
+                "version": DATASET_FORMAT_VERSION,
+                "episode_length": None,
+                "latent": None,
+                "defer_curiosity": False,
+                "shards": [],
+            }
+
+    """
+    Write the finished episodes of memory as a new shard
+    """
+    def write_memory(self, memory):
+        # the frames of a DemoMemory would have to be re-rendered all at once
+        if memory.demos:
+            raise ValueError("The episodes of a DemoMemory (recorded as demos) can not be written "
+                "to a dataset")
+        n_episodes = memory.active_episode
+        if n_episodes == 0:
+            return
+
+        # the stored rewards of memories with deferred curiosity do not include it
+        defer_curiosity = memory.mix_reward is not None
+        if len(self.index["shards"]) == 0:
+            self.index["episode_length"] = memory.episode_length
+            self.index["latent"] = memory.latent
+            self.index["defer_curiosity"] = defer_curiosity
+        elif self.index["episode_length"] != memory.episode_length or\
+            self.index["latent"] != memory.latent or\
+            self.index.get("defer_curiosity", False) != defer_curiosity:
+            raise ValueError("Memory does not match the format of the dataset in {}".format(
+                self.directory))
+
+        # only up to the end of the longest episode, the rest is padding
+        length = int(np.amax(memory.episode_lengths[:n_episodes]))
+        arrays = {
+            "actions": memory.actions[:length, :n_episodes],
+            "rewards": memory.rewards[:length, :n_episodes],
+            "masks": memory.masks[:length, :n_episodes],
+            "episode_lengths": memory.episode_lengths[:n_episodes],
+            "episode_info": np.array(json.dumps(memory.episode_info[:n_episodes])),
+        }
+        if memory.latent is None:
+            arrays["images"] = memory.get_frames(0, length)[:, :n_episodes]
+        else:
+            arrays["image_encs"] = memory.image_encs[:length, :n_episodes]
+
+        filename = "shard-{:06d}.npz".format(len(self.index["shards"]))
+        save = np.savez_compressed if self.compress else np.savez
+        write_atomically(os.path.join(self.directory, filename), lambda f: save(f, **arrays))
+
+        self.index["shards"].append({
+            "filename": filename,
+            "n_episodes": n_episodes,
+            "length": length,
+        })
+        write_atomically(index_path(self.directory),
+            lambda f: f.write(json.dumps(self.index, indent=1).encode()))
+
+
+class EpisodeDataset:
+    """
+    Streaming reader of a dataset written by DatasetWriter
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = load_index(directory)
+        if self.index is None or len(self.index["shards"]) == 0:
+            raise FileNotFoundError("No dataset in {}".format(directory))
+        self.episode_length = self.index["episode_length"]
+        self.latent = self.index["latent"]
+        self.defer_curiosity = self.index.get("defer_curiosity", False)
+
+    def n_episodes(self):
+        return sum(shard["n_episodes"] for shard in self.index["shards"])
+
+    def shard_paths(self):
+        return [os.path.join(self.directory, shard["filename"])
+            for shard in self.index["shards"]]
+
+    """
+    Yield the episodes of a shard, padded to episode_length
+
+    ret: (observations, actions, rewards, masks, episode length) per episode
+    """
+    def load_episodes(self, path):
+        if isinstance(path, bytes):
+            path = path.decode()
+
+        with np.load(path) as shard:
+            observations = shard["images" if self.latent is None else "image_encs"]
+            actions, rewards, masks = shard["actions"], shard["rewards"], shard["masks"]
+            padding = self.episode_length - observations.shape[0]
+            for e, episode_length in enumerate(shard["episode_lengths"]):
+                def pad(x):
+                    return np.pad(x[:, e], [(0, padding)] + [(0, 0)]*(x.ndim-2))
+                yield pad(observations), pad(actions), pad(rewards), pad(masks),\
+                    np.int32(episode_length)
+
+    """
+    tf.data pipeline of single episodes
+
+    The shards are decoded n_parallel at a time and interleaved, with shuffle the shard order
+    and (within shuffle_buffer episodes) the episode order are random.
+    """
+    def episodes(self, shuffle=True, shuffle_buffer=8, n_parallel=4, seed=None):
+        import tensorflow as tf
+
+        if self.latent is None:
+            observation_spec = tf.TensorSpec(shape=(self.episode_length, 240, 320, 4),
+                dtype=tf.uint8)
+        else:
+            observation_spec = tf.TensorSpec(shape=(self.episode_length, 256),
+                dtype=tf.float16 if self.latent == "float16" else tf.int8)
+        output_signature = (
+            observation_spec,
+            tf.TensorSpec(shape=(self.episode_length, 15), dtype=tf.float32),
+            tf.TensorSpec(shape=(self.episode_length,), dtype=tf.float32),
+            tf.TensorSpec(shape=(self.episode_length,), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        )
+
+        paths = tf.data.Dataset.from_tensor_slices(self.shard_paths())
+        if shuffle:
+            paths = paths.shuffle(len(self.index["shards"]), seed=seed,
+                reshuffle_each_iteration=True)
+        dataset = paths.interleave(
+            lambda path: tf.data.Dataset.from_generator(self.load_episodes, args=(path,),
+                output_signature=output_signature),
+            cycle_length=n_parallel, num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=not shuffle)
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+        return dataset
+
+    """
+    Yield full replay memories of n_episodes random episodes each, forever if repeat
+
+    mix_reward: see Memory, required if the dataset was recorded with deferred curiosity
+    """
+    def memories(self, n_episodes, discount_factor=0.98, mix_reward=None, repeat=True,
+        **kwargs):
+        import tensorflow as tf
+
+        if self.defer_curiosity and mix_reward is None:
+            raise ValueError("The rewards in {} leave out the curiosity reward (deferred "
+                "curiosity), memories needs the mix_reward of the trainer".format(self.directory))
+
+        dataset = self.episodes(**kwargs)
+        if repeat:
+            dataset = dataset.repeat()
+        dataset = dataset.batch(n_episodes, drop_remainder=True).prefetch(1)
+
+        for observations, actions, rewards, masks, episode_lengths in dataset:
+            memory = Memory(n_episodes, self.episode_length, discount_factor=discount_factor,
+                latent=self.latent, mix_reward=mix_reward)
+            # (episode, time step) -> (time step, episode)
+            if self.latent is None:
+                memory.images[:] = np.swapaxes(observations.numpy(), 0, 1)
+            else:
+                memory.image_encs[:] = np.swapaxes(observations.numpy(), 0, 1)
+            memory.actions[:] = np.swapaxes(actions.numpy(), 0, 1)
+            memory.rewards[:] = np.swapaxes(rewards.numpy(), 0, 1)
+            memory.masks[:] = np.swapaxes(masks.numpy(), 0, 1)
+            memory.episode_lengths[:] = episode_lengths.numpy()
+            memory.active_episode = n_episodes
+            memory.discount_rewards()
+            yield memory
+
+    """
+    tf.data pipeline of shuffled (batch_size, 240, 320, 4) uint8 frame batches
+    """
+    def frames(self, batch_size, shuffle_buffer=4096, repeat=True, **kwargs):
+        import tensorflow as tf
+
+        if self.latent is not None:
+            raise ValueError("The dataset in {} only holds image encodings".format(
+                self.directory))
+
+        dataset = self.episodes(**kwargs)
+        if repeat:
+            dataset = dataset.repeat()
+        dataset = dataset.flat_map(lambda observations, actions, rewards, masks, length:
+            tf.data.Dataset.from_tensor_slices(observations[:length]))
+        return dataset.shuffle(shuffle_buffer).batch(batch_size, drop_remainder=True)\
+            .prefetch(tf.data.AUTOTUNE)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, default="data/episodes")
+    parser.add_argument('--checkpoint_dir', type=str, default="model/checkpoints")
+    parser.add_argument('--keep_checkpoints', type=int, default=3)
+    parser.add_argument('--cycles', type=int, default=64,
+        help="replay memories to train on, each with n_replay_episodes episodes")
+    parser.add_argument('--n_replay_episodes', type=int, default=8)
+    parser.add_argument('--n_training_epochs', type=int, default=4)
+    parser.add_argument('--replay_sample_length', type=int, default=256)
+    args = parser.parse_args()
+
+    from model import Model
+    from checkpoint import CheckpointWriter, load_latest_checkpoint
+
+    dataset = EpisodeDataset(args.dataset_dir)
+    print("Training on {} episodes from {}".format(dataset.n_episodes(), args.dataset_dir))
+
+    model = Model(dataset.episode_length, args.n_replay_episodes, args.n_training_epochs,
+        args.replay_sample_length)
+    checkpoint = load_latest_checkpoint(args.checkpoint_dir)
+    if checkpoint is not None:
+        model.set_checkpoint_state(checkpoint[1])
+    model.checkpoint_writer = CheckpointWriter(args.checkpoint_dir, keep=args.keep_checkpoints)
+
+    mix_reward = mix_reward_simple if dataset.defer_curiosity else None
+    for i, memory in enumerate(dataset.memories(args.n_replay_episodes, mix_reward=mix_reward)):
+        if i >= args.cycles:
+            break
+        print("Training cycle {}/{}".format(i+1, args.cycles))
+        model.train(memory)
+
+    model.checkpoint_writer.close()
+
+
+if __name__ == "__main__":
+    main()
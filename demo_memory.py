@@ -0,0 +1,192 @@
+import collections
+import glob
+import multiprocessing
+import os
+import shutil
+import numpy as np
+
+from memory import Memory
+
+
+# populated in every replay worker process by init_worker
+worker = {}
+
+
+def init_worker(episode_length):
+    from init_game import init_game
+
+    worker["game"] = init_game(episode_length, False)
+    worker["wad"] = None
+
+
+"""
+Replay a recorded episode and grab the frames of time steps begin...begin+length
+
+task: (demo path, wad filename, map name, begin, length)
+ret: (length, 240, 320, 4) uint8 frames, zero past the end of the episode
+"""
+def replay_episode(task):
+    demo_path, wad_filename, map_name, begin, length = task
+    game = worker["game"]
+
+    # the game is only restarted when the wad changes
+    if worker["wad"] != wad_filename:
+        game.close()
+        game.set_doom_scenario_path(wad_filename)
+        game.init()
+        worker["wad"] = wad_filename
+
+    game.set_doom_map(map_name)
+    game.replay_episode(demo_path)
+    game.send_game_command('am_scale 0.5') # same automap as when the episode was played
+
+    frames = np.zeros((length, 240, 320, 4), dtype=np.uint8)
+    time_step = 0
+    while not game.is_episode_finished() and time_step < begin+length:
+        if time_step >= begin:
+            state_game = game.get_state()
+            frames[time_step-begin, :, :, 0:3] = state_game.screen_buffer
+            frames[time_step-begin, :, :, 3] = state_game.automap_buffer[:,:,0]
+        # the state (and its buffers) is only needed from begin on, the hud numbers are only
+        # updated on rendered tics and lag by one, so rendering starts two tics before begin
+        game.advance_action(1, time_step+2 >= begin)
+        time_step += 1
+    return frames
+
+
+class DemoMemory(Memory):
+    """
+    Replay memory that records ViZDoom demos (.lmp) instead of storing the frames
+
+    Actions, rewards and masks are stored like in Memory, in storage_dir next to the demos and
+    a copy of every map wad that was played. Frames are re-rendered on demand by replaying the
+    demos in n_workers game processes, the last cache_size decoded windows are kept. Whole
+    episodes are only ever re-rendered replay_chunk_size time steps at a time.
+    """
+    demos = True
+
+    def __init__(self, n_episodes, episode_length, discount_factor=0.995,
+        storage_dir="model/demos", restore=False, n_workers=4, cache_size=2, replay_chunk_size=128,
+        mix_reward=None):
+        if storage_dir is None:
+            raise ValueError("DemoMemory needs a storage_dir for the demos")
+
+        self.n_workers = n_workers
+        self.cache_size = cache_size
+        self.replay_chunk_size = replay_chunk_size
+        self.window_cache = collections.OrderedDict() # (begin, length) -> frames
+        self.pool = None
+        super().__init__(n_episodes, episode_length, discount_factor=discount_factor,
+            storage_dir=storage_dir, restore=restore, mix_reward=mix_reward)
+
+
+    def allocate_observations(self, mode="w+"):
+        self.images = None
+        self.image_encs = None
+
+
+    def clear(self):
+        self.window_cache.clear()
+        # the wads and demos of the previous memory are not referenced anymore
+        for pattern in ("map_*.wad", "episode_*.lmp"):
+            for filename in glob.glob(os.path.join(self.storage_dir, pattern)):
+                os.remove(filename)
+        super().clear()
+
+
+    def get_metadata(self):
+        metadata = super().get_metadata()
+        metadata["demos"] = True
+        return metadata
+
+
+    def wad_filename(self, seed):
+        return os.path.join(self.storage_dir, "map_{}.wad".format(seed))
+
+
+    """
+    ret: path to record the episode demo into (game.new_episode(path))
+    """
+    def begin_episode(self, map_info=None):
+        if map_info is None:
+            raise ValueError("DemoMemory needs the map of every episode to replay it")
+        super().begin_episode(map_info)
+
+        # keep the wad the demo is played on, the trainer overwrites its own copy
+        wad_filename = self.wad_filename(map_info["seed"])
+        if not os.path.exists(wad_filename):
+            shutil.copyfile(map_info["wad"], wad_filename)
+
+        demo_path = os.path.join(self.storage_dir, "episode_{:04d}.lmp".format(
+            self.active_episode))
+        self.episode_info[self.active_episode]["demo"] = demo_path
+        self.window_cache.clear()
+        return demo_path
+
+
+    # the frame is re-rendered from the demo
+    def store_observation(self, time_step, image):
+        pass
+
+
+    """
+    Encode the frames of whole episodes chunk by chunk, at most replay_chunk_size time steps of
+    frames exist at once
+    """
+    def encode_frames(self, encode_images, length):
+        import tensorflow as tf
+
+        image_encs = [encode_images(self.replay_frames(begin,
+            min(self.replay_chunk_size, length-begin)))
+            for begin in range(0, length, self.replay_chunk_size)]
+        return tf.concat(image_encs, axis=0)
+
+
+    def get_frames(self, begin, length):
+        key = (begin, length)
+        if key in self.window_cache:
+            self.window_cache.move_to_end(key)
+            return self.window_cache[key]
+
+        frames = self.replay_frames(begin, length)
+        # windows of whole episodes would take gigabytes, they are not kept
+        if length < self.episode_length:
+            self.window_cache[key] = frames
+            while len(self.window_cache) > self.cache_size:
+                self.window_cache.popitem(last=False)
+        return frames
+
+
+    """
+    Re-render the frames of time steps begin...begin+length of all episodes
+    """
+    def replay_frames(self, begin, length):
+        frames = np.zeros((length, self.n_episodes, 240, 320, 4), dtype=np.uint8)
+        episodes = [e for e in range(self.n_episodes)
+            if self.episode_info[e] is not None and self.episode_lengths[e] > begin]
+        tasks = []
+        for e in episodes:
+            info = self.episode_info[e]
+            wad_filename = self.wad_filename(info["seed"])
+            if not os.path.exists(wad_filename):
+                # the copy was lost, oblige generates the same maps from the same seed
+                from generate_maps import generate_maps
+                generate_maps(filename=wad_filename, seed=info["seed"])
+            tasks.append((info["demo"], wad_filename, info["map"], begin, length))
+
+        if len(tasks) > 0:
+            if self.pool is None:
+                # the game processes are started from scratch, TensorFlow does not survive a fork
+                context = multiprocessing.get_context("spawn")
+                self.pool = context.Pool(self.n_workers, initializer=init_worker,
+                    initargs=(self.episode_length,))
+            for e, episode_frames in zip(episodes, self.pool.map(replay_episode, tasks)):
+                frames[:, e] = episode_frames
+        return frames
+
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
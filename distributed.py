@@ -0,0 +1,88 @@
+#####################################################################
+# Data-parallel training over several processes (e.g. the cores of a
+# big CPU node). Every worker collects its own share of the replay
+# episodes and trains on them; the gradients of all training phases
+# are all-reduced with collective ops, so the weights stay identical.
+#
+#   python3 main.py --workers 4        # launches 4 local workers
+#####################################################################
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+"""
+ret: list of n "localhost:port" addresses with currently unused ports
+"""
+def get_local_hosts(n):
+    sockets = []
+    for i in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(("localhost", 0))
+        sockets.append(s)
+    hosts = ["localhost:{}".format(s.getsockname()[1]) for s in sockets]
+    for s in sockets:
+        s.close()
+    return hosts
+
+
+"""
+Create the MultiWorkerMirroredStrategy of this worker
+
+Has to be called before any other TensorFlow operation in the process. Worker 0 is the chief.
+"""
+def create_strategy(worker_hosts, worker_index):
+    os.environ["TF_CONFIG"] = json.dumps({
+        "cluster": {"worker": list(worker_hosts)},
+        "task": {"type": "worker", "index": worker_index},
+    })
+
+    import tensorflow as tf
+    # ring all-reduce works on CPU, NCCL only on GPU
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+"""
+Start n_workers copies of this script on the local machine and wait for them
+
+argv: command line of this process, --workers is passed on and --worker_index/--worker_hosts
+are appended for each worker
+ret: exit code, nonzero if any worker failed
+"""
+def launch_local_workers(n_workers, argv):
+    hosts = get_local_hosts(n_workers)
+    processes = []
+    for i in range(n_workers):
+        command = [sys.executable] + argv + ["--worker_index", str(i),
+            "--worker_hosts"] + hosts
+        processes.append(subprocess.Popen(command))
+
+    # the others would block in their collectives forever after a worker fails, so they are
+    # terminated, every process is waited for
+    exit_code = 0
+    running = list(processes)
+    while len(running) > 0:
+        time.sleep(1.0)
+        for process in [p for p in running if p.poll() is not None]:
+            running.remove(process)
+            if process.returncode != 0 and exit_code == 0:
+                exit_code = process.returncode
+                for other in running:
+                    other.terminate()
+    return exit_code
+
+
+"""
+ret: path with a per-worker suffix, or path unchanged for a single worker (or None)
+"""
+def worker_path(path, worker_index, n_workers):
+    if path is None or n_workers <= 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}_{}{}".format(root, worker_index, extension)
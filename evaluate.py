@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Headless evaluation of the greedy policy. Plays a fixed set of
+# Oblige seeds and maps in parallel ViZDoom processes without
+# exploration noise or replay memory, and writes a summary report.
+#
+#   python3 evaluate.py --checkpoint_dir model/checkpoints --seeds 1 2 3 --workers 4
+#   python3 evaluate.py --bundle model/export    # exported policy, see export.py
+#####################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+
+
+# populated in every worker process by init_worker
+worker = {}
+
+
+class CheckpointPolicy:
+    """
+    Greedy policy of the full model restored from a checkpoint
+    """
+    def __init__(self, checkpoint_dir, n_action_models, action_model_id):
+        from model import Model
+        from checkpoint import load_latest_checkpoint
+
+        self.model = Model(1024, n_action_models, 1, 256)
+        checkpoint = load_latest_checkpoint(checkpoint_dir)
+        if checkpoint is None:
+            raise FileNotFoundError("No checkpoints in {}".format(checkpoint_dir))
+        self.model.set_checkpoint_state(checkpoint[1])
+        self.action_model_id = action_model_id
+
+    def reset(self):
+        self.model.reset_state()
+        self.action_prev = np.zeros((15,), dtype=np.float32)
+
+    def act(self, image):
+        self.model.advance(image, self.action_prev)
+        self.action_prev = self.model.predict_action(self.action_model_id)
+        return self.action_prev
+
+
+def eval_wad_filename(seed):
+    return "wads/temp/eval_{}.wad".format(seed)
+
+
+def init_worker(options):
+    from init_game import init_game
+
+    if options["bundle"] is not None:
+        from player import Player
+        worker["policy"] = Player(options["bundle"])
+    else:
+        worker["policy"] = CheckpointPolicy(options["checkpoint_dir"],
+            options["n_action_models"], options["action_model"])
+    worker["game"] = init_game(options["episode_length"], False)
+    worker["seed"] = None
+
+
+"""
+Play one greedy episode on the given seed and map
+
+ret: dict of episode metrics
+"""
+def play_episode(task):
+    import vizdoom as vzd
+    from reward import Reward
+    from utils import get_player_pos, convert_action_to_mixed
+
+    seed, map_name = task
+    game = worker["game"]
+    policy = worker["policy"]
+
+    # the game is only restarted when the wad changes
+    if worker["seed"] != seed:
+        game.close()
+        game.set_doom_scenario_path(eval_wad_filename(seed))
+        game.init()
+        worker["seed"] = seed
+
+    game.set_doom_map(map_name)
+    game.new_episode()
+    game.send_game_command('am_scale 0.5')
+
+    reward = Reward(get_player_pos(game))
+    policy.reset()
+    reward_components = {name: 0.0 for name in reward.reward_weights}
+    game_variables = {name: 0.0 for name in
+        ("kills", "items", "damage_taken", "damage_dealt", "health", "distance")}
+    distance_max = 0.0
+    n_steps = 0
+    t_begin = time.perf_counter()
+
+    while not game.is_episode_finished():
+        state_game = game.get_state()
+        image = np.concatenate([state_game.screen_buffer,
+            state_game.automap_buffer[:,:,0:1]], axis=-1)
+        action = policy.act(image)
+        game.make_action(convert_action_to_mixed(action))
+        n_steps += 1
+
+        if game.is_episode_finished():
+            break
+
+        for name, value in reward.get_reward_components(game, action).items():
+            reward_components[name] += value
+        distance_max = max(distance_max, reward.get_distance(game))
+        # the variables are not available anymore once the episode has finished
+        game_variables = {
+            "kills": game.get_game_variable(vzd.KILLCOUNT),
+            "items": game.get_game_variable(vzd.ITEMCOUNT),
+            "damage_taken": game.get_game_variable(vzd.DAMAGE_TAKEN),
+            "damage_dealt": game.get_game_variable(vzd.DAMAGECOUNT),
+            "health": game.get_game_variable(vzd.HEALTH),
+            "distance": reward.get_distance(game),
+        }
+
+    result = {
+        "seed": seed,
+        "map": map_name,
+        "episode_length": n_steps,
+        "died": game.is_player_dead(),
+        "distance_max": distance_max,
+        "steps_per_second": n_steps / (time.perf_counter() - t_begin),
+    }
+    result.update(game_variables)
+    result.update({"reward_" + name: value for name, value in reward_components.items()})
+    return result
+
+
+"""
+ret: dict of metric name -> mean over the given episode results (numeric metrics only)
+"""
+def summarize(results):
+    keys = [k for k, v in results[0].items()
+        if isinstance(v, (int, float, bool)) and k != "seed"]
+    return {k: float(np.mean([r[k] for r in results])) for k in keys}
+
+
+"""
+Evaluate the policy over all (seed, map) combinations with n_workers game processes
+
+ret: report dict with the per-episode results and the overall and per-map means
+"""
+def evaluate(seeds, maps, n_workers=4, checkpoint_dir="model/checkpoints", bundle=None,
+    n_action_models=8, action_model=0, episode_length=1024, output=None):
+    from generate_maps import generate_maps
+
+    # generate the maps up front so that the workers do not race for the files
+    for seed in seeds:
+        if not os.path.exists(eval_wad_filename(seed)):
+            generate_maps(filename=eval_wad_filename(seed), seed=seed)
+
+    options = {
+        "checkpoint_dir": checkpoint_dir,
+        "bundle": bundle,
+        "n_action_models": n_action_models,
+        "action_model": action_model,
+        "episode_length": episode_length,
+    }
+    # seed-major order, so each worker mostly keeps the same wad loaded
+    tasks = [(seed, map_name) for seed in seeds for map_name in maps]
+
+    t_begin = time.perf_counter()
+    # TensorFlow does not survive a fork, start the workers from scratch
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(min(n_workers, len(tasks)), initializer=init_worker,
+        initargs=(options,)) as pool:
+        results = []
+        for result in pool.imap_unordered(play_episode, tasks):
+            results.append(result)
+            print("Evaluated {}/{} episodes".format(len(results), len(tasks)), end="\r")
+    print("")
+
+    results.sort(key=lambda r: (r["seed"], r["map"]))
+    report = {
+        "checkpoint_dir": checkpoint_dir,
+        "bundle": bundle,
+        "seconds": time.perf_counter() - t_begin,
+        "summary": summarize(results),
+        "maps": {m: summarize([r for r in results if r["map"] == m]) for m in maps},
+        "episodes": results,
+    }
+
+    if output is not None:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Evaluation report written to {}".format(output))
+
+    return report
+
+
+def print_report(report):
+    print("Evaluated {} episodes in {:.1f} s".format(len(report["episodes"]), report["seconds"]))
+    for name, value in report["summary"].items():
+        print("{:>24}: {:12.3f}".format(name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_dir', type=str, default="model/checkpoints")
+    parser.add_argument('--bundle', type=str, default=None,
+        help="evaluate an exported policy (see export.py) instead of a checkpoint")
+    parser.add_argument('--seeds', type=int, nargs="+", default=[1507715517])
+    parser.add_argument('--maps', type=str, nargs="+",
+        default=["map01", "map02", "map03", "map04"])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--n_action_models', type=int, default=8)
+    parser.add_argument('--action_model', type=int, default=0)
+    parser.add_argument('--episode_length', type=int, default=1024)
+    parser.add_argument('--output', type=str, default="eval/report.json")
+    args = parser.parse_args()
+
+    report = evaluate(args.seeds, args.maps, n_workers=args.workers,
+        checkpoint_dir=args.checkpoint_dir, bundle=args.bundle,
+        n_action_models=args.n_action_models, action_model=args.action_model,
+        episode_length=args.episode_length, output=args.output)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
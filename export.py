@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Export the acting part of a trained model for inference only:
+# image encoder -> state -> action model, plus model_encoding for the
+# curiosity signal. Writes a SavedModel and optionally a TFLite file
+# (with optional int8 post-training quantization).
+#
+#   python3 export.py --checkpoint_dir model/checkpoints --output model/export \
+#       --tflite --quantize --memory_dir model/replay
+#
+# Use player.py to run the exported bundle.
+#####################################################################
+
+import argparse
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+
+class PolicyModule(tf.Module):
+    """
+    One step of the acting graph, stateless so that it can be served anywhere
+
+    The caller carries image_enc and state between steps (player.Player does this).
+    """
+    def __init__(self, model, action_model_id=0):
+        super().__init__()
+        self.model_image_encoder = model.model_image_encoder
+        self.model_state = model.model_state
+        self.model_encoding = model.model_encoding
+        self.model_action = model.models_action[action_model_id].model_action
+
+        self.step = tf.function(self.step_graph, input_signature=[
+            tf.TensorSpec(shape=(1, 240, 320, 4), dtype=tf.uint8, name="image"),
+            tf.TensorSpec(shape=(1, 15), dtype=tf.float32, name="action_prev"),
+            tf.TensorSpec(shape=(1, model.image_enc_size), dtype=tf.float32, name="image_enc"),
+            tf.TensorSpec(shape=(1, model.state_size), dtype=tf.float32, name="state")
+        ])
+
+    def step_graph(self, image, action_prev, image_enc, state):
+        # same computation as Model.advance followed by Model.predict_action
+        image_enc_pred = self.model_encoding([image_enc, state, action_prev], training=False)
+
+        image_enc = self.model_image_encoder(
+            tf.cast(image, tf.float32) * 0.0039215686274509803, training=False)
+        state = self.model_state([state, image_enc], training=False)
+        action = self.model_action(state, training=False)
+
+        return {
+            "action": action,
+            "image_enc": image_enc,
+            "state": state,
+            "curiosity": tf.reduce_mean(tf.abs(image_enc - image_enc_pred), axis=-1),
+        }
+
+
+"""
+Open a memory stored with Memory(storage_dir=...) for calibration
+"""
+def open_memory(storage_dir):
+    from memory import Memory
+
+    with open(os.path.join(storage_dir, "memory.json")) as f:
+        metadata = json.load(f)
+    if metadata.get("latent") is not None:
+        raise ValueError("Calibration needs frames, {} only holds image encodings".format(
+            storage_dir))
+    return Memory(metadata["n_episodes"], metadata["episode_length"], storage_dir=storage_dir,
+        restore=True)
+
+
+"""
+Yield calibration inputs: stored frames played through the policy so that the state and
+encoding inputs have realistic ranges as well
+"""
+def representative_dataset(policy, memory, n_steps):
+    n_episodes = max(memory.active_episode, 1)
+    steps_per_episode = max(n_steps // n_episodes, 1)
+
+    for e in range(n_episodes):
+        image_enc = tf.zeros((1, policy.model_image_encoder.output_shape[-1]))
+        state = tf.zeros((1, policy.model_state.output_shape[-1]))
+        action_prev = tf.zeros((1, 15))
+        for t in range(min(steps_per_episode, memory.episode_lengths[e])):
+            inputs = {
+                "image": memory.images[t, e][None],
+                "action_prev": action_prev.numpy(),
+                "image_enc": image_enc.numpy(),
+                "state": state.numpy(),
+            }
+            yield inputs
+
+            outputs = policy.step(**inputs)
+            image_enc, state = outputs["image_enc"], outputs["state"]
+            action_prev = tf.convert_to_tensor(memory.actions[t, e][None])
+
+
+"""
+Write the SavedModel into directory, and policy.tflite next to it if requested
+
+memory: calibration frames for int8 quantization (required if quantize)
+"""
+def export_policy(model, directory, action_model_id=0, tflite=False, quantize=False,
+    memory=None, n_calibration_steps=256):
+    policy = PolicyModule(model, action_model_id)
+    tf.saved_model.save(policy, directory,
+        signatures={"serving_default": policy.step.get_concrete_function()})
+    print("Saved model exported to {}".format(directory))
+
+    if not tflite:
+        return
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(directory,
+        signature_keys=["serving_default"])
+    if quantize:
+        if memory is None:
+            raise ValueError("int8 quantization needs calibration frames from a memory")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: representative_dataset(
+            policy, memory, n_calibration_steps)
+
+    filename = os.path.join(directory, "policy.tflite")
+    with open(filename, "wb") as f:
+        f.write(converter.convert())
+    print("TFLite model exported to {}".format(filename))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_dir', type=str, default="model/checkpoints")
+    parser.add_argument('--model', type=str, default=None,
+        help="legacy .h5 prefix to load instead of the latest checkpoint")
+    parser.add_argument('--output', type=str, default="model/export")
+    parser.add_argument('--n_action_models', type=int, default=8)
+    parser.add_argument('--action_model', type=int, default=0)
+    parser.add_argument('--tflite', action='store_true')
+    parser.add_argument('--quantize', action='store_true',
+        help="int8 post-training quantization of the TFLite model")
+    parser.add_argument('--memory_dir', type=str, default=None,
+        help="stored replay memory used for calibrating the quantization")
+    parser.add_argument('--calibration_steps', type=int, default=256)
+    args = parser.parse_args()
+
+    from model import Model
+    from checkpoint import load_latest_checkpoint
+
+    model = Model(1024, args.n_action_models, 1, 256)
+    if args.model is not None:
+        model.load_model(args.model)
+    else:
+        checkpoint = load_latest_checkpoint(args.checkpoint_dir)
+        if checkpoint is None:
+            raise FileNotFoundError("No checkpoints in {}".format(args.checkpoint_dir))
+        model.set_checkpoint_state(checkpoint[1])
+
+    memory = open_memory(args.memory_dir) if args.memory_dir is not None else None
+    export_policy(model, args.output, action_model_id=args.action_model, tflite=args.tflite,
+        quantize=args.quantize, memory=memory, n_calibration_steps=args.calibration_steps)
+
+
+if __name__ == "__main__":
+    main()
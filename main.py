@@ -20,10 +20,12 @@ from time import sleep
 
 from init_game import init_game
 from reward import Reward
-from model import Model
-from trainer_simple import TrainerSimple
+from checkpoint import CheckpointWriter, load_latest_checkpoint
+from distributed import create_strategy, launch_local_workers, worker_path
 import utils
 import argparse
+import random
+import sys
 
 import faulthandler
 faulthandler.enable()
@@ -33,7 +35,52 @@ def main():
     parser = argparse.ArgumentParser()
     model_filename = ""
     parser.add_argument('--model', type=str)
+    parser.add_argument('--checkpoint_dir', type=str, default="model/checkpoints")
+    parser.add_argument('--keep_checkpoints', type=int, default=3)
+    parser.add_argument('--resume', action='store_true',
+        help="continue from the latest checkpoint in --checkpoint_dir")
+    parser.add_argument('--memory_dir', type=str, default=None,
+        help="keep the replay memory memory-mapped in this directory so --resume can reuse it")
+    parser.add_argument('--planner', type=str, choices=["cem", "shooting"], default=None,
+        help="pick greedy actions by planning with the world model instead of the action models")
+    parser.add_argument('--plan_horizon', type=int, default=8)
+    parser.add_argument('--plan_candidates', type=int, default=256)
+    parser.add_argument('--eval_every', type=int, default=0,
+        help="evaluate the greedy policy after every n training cycles (0 disables)")
+    parser.add_argument('--eval_seeds', type=int, nargs="+", default=[1507715517])
+    parser.add_argument('--eval_workers', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1,
+        help="data-parallel training processes, the replay episodes are split between them")
+    parser.add_argument('--worker_index', type=int, default=None,
+        help="index of this worker, set by the launcher")
+    parser.add_argument('--worker_hosts', type=str, nargs="+", default=None,
+        help="host:port of every worker, set by the launcher")
+    parser.add_argument('--recompute_grad', action='store_true',
+        help="recompute the unroll activations in the backward pass to save training memory")
+    parser.add_argument('--latent_replay', type=str, choices=["float16", "int8"], default=None,
+        help="store the image encodings instead of the frames in the replay memory")
+    parser.add_argument('--demo_dir', type=str, default=None,
+        help="record the replay episodes as demos in this directory instead of storing frames")
+    parser.add_argument('--action_latency', type=int, choices=[0, 1], default=0,
+        help="1 overlaps the inference on a frame with the simulation of the next tic")
+    parser.add_argument('--xla', action='store_true',
+        help="XLA compile the training steps and the per-step inference")
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+        help="window starts per optimizer update of the encoder phase and the backbone")
+    parser.add_argument('--defer_curiosity', action='store_true',
+        help="compute the curiosity reward in batches at training time instead of every step")
+    parser.add_argument('--window_strides', type=int, nargs=3, default=[1, 1, 1],
+        metavar=("ENCODER", "BACKBONE", "ACTION"),
+        help="steps between the training window starts of the encoder, backbone and action phases")
+    parser.add_argument('--shared_windows', type=int, default=1,
+        help="training windows served by one unroll (and update) per training step")
+    parser.add_argument('--dataset_dir', type=str, default=None,
+        help="also append every collected replay memory to the episode dataset in this directory")
     args = parser.parse_args()
+
+    # started without an index: this process only launches the workers
+    if args.workers > 1 and args.worker_index is None:
+        sys.exit(launch_local_workers(args.workers, sys.argv))
     model_filename = args.model
     # model_filename = "model/model" # TODO TEMP
 
@@ -44,6 +91,22 @@ def main():
     n_replay_episodes = 8
     n_training_epochs = 4
     window_visible = False
+
+    if args.dataset_dir is not None and args.demo_dir is not None:
+        raise ValueError("--dataset_dir can not store the episodes of --demo_dir (demos)")
+    if n_replay_episodes % args.workers != 0:
+        raise ValueError("{} replay episodes can not be split between {} workers".format(
+            n_replay_episodes, args.workers))
+    # episodes collected and trained on by this worker
+    batch_size = n_replay_episodes // args.workers
+    worker_index = args.worker_index if args.worker_index is not None else 0
+    is_chief = worker_index == 0
+
+    # the strategy has to exist before TensorFlow does anything else
+    strategy = None
+    if args.workers > 1:
+        strategy = create_strategy(args.worker_hosts, worker_index)
+
     game = init_game(episode_length, window_visible)
 
     game.new_episode()
@@ -52,24 +115,93 @@ def main():
     print("Player start pos:", player_start_pos)
 
     reward_controller = Reward(player_start_pos)
-    model = Model(episode_length, n_replay_episodes, n_training_epochs, replay_sample_length)
+
+    # TensorFlow is only imported here so that argument parsing and the game setup do not
+    # wait for it
+    from model import Model
+    from trainer_simple import TrainerSimple
+
+    model = Model(episode_length, n_replay_episodes, n_training_epochs, replay_sample_length,
+        batch_size=batch_size, strategy=strategy, recompute_grad=args.recompute_grad,
+        jit_compile=args.xla, accumulation_steps=args.accumulation_steps,
+        window_stride_encoder=args.window_strides[0], window_stride_backbone=args.window_strides[1],
+        window_stride_action=args.window_strides[2], shared_windows=args.shared_windows)
+    model.is_chief = is_chief
 
     if model_filename is not None:
         print("Loading model ({})".format(model_filename))
         model.load_model(model_filename)
-    trainer = TrainerSimple(model, reward_controller, n_replay_episodes, episode_length,
-        min_episode_length, window_visible)
+
+    planner = None
+    if args.planner is not None:
+        from planner import Planner
+        planner = Planner(model, horizon=args.plan_horizon, n_candidates=args.plan_candidates,
+            method=args.planner)
+
+    trainer = TrainerSimple(model, reward_controller, batch_size, episode_length,
+        min_episode_length, window_visible,
+        memory_dir=worker_path(args.memory_dir, worker_index, args.workers), planner=planner,
+        wad_filename=worker_path("wads/temp/oblige.wad", worker_index, args.workers),
+        memory_latent=args.latent_replay,
+        demo_dir=worker_path(args.demo_dir, worker_index, args.workers),
+        action_latency=args.action_latency, defer_curiosity=args.defer_curiosity)
+
+    if args.resume:
+        checkpoint = load_latest_checkpoint(args.checkpoint_dir)
+        if checkpoint is not None:
+            model.set_checkpoint_state(checkpoint[1])
+            trainer.set_checkpoint_state(checkpoint[1])
+            # the checkpoint holds the chief's random state, the other workers need their own
+            # to play different maps
+            if not is_chief:
+                random.seed()
+                np.random.seed()
+                trainer.action_noise = utils.ActionNoise()
+        else:
+            print("No checkpoints found in {}, starting from scratch".format(args.checkpoint_dir))
+        trainer.restore_memory()
+    if is_chief:
+        model.checkpoint_writer = CheckpointWriter(args.checkpoint_dir,
+            keep=args.keep_checkpoints)
+        model.checkpoint_extra_state = trainer.get_checkpoint_state
+
+    dataset_writer = None
+    if args.dataset_dir is not None:
+        from dataset import DatasetWriter
+        dataset_writer = DatasetWriter(worker_path(args.dataset_dir, worker_index, args.workers))
 
     print("Model setup complete. Starting training episodes")
 
+    # crashed during training, no need to collect the memory again (not when distributed, all
+    # workers have to train at the same time)
+    if strategy is None and trainer.memory is not None and trainer.memory.is_full():
+        model.train(trainer.memory)
+
     for i in range(runs):
         memory = trainer.run(game)
+        if dataset_writer is not None:
+            dataset_writer.write_memory(memory)
         model.train(memory)
 
+        if is_chief and args.eval_every > 0 and (i+1) % args.eval_every == 0:
+            from evaluate import evaluate, print_report
+            model.checkpoint_writer.wait() # evaluate the checkpoint that was just written
+            print_report(evaluate(args.eval_seeds, ["map01", "map02", "map03", "map04"],
+                n_workers=args.eval_workers, checkpoint_dir=args.checkpoint_dir,
+                n_action_models=n_replay_episodes, episode_length=episode_length,
+                output="eval/report_{:05d}.json".format(i)))
+
     # It will be done automatically anyway but sometimes you need to do it in the middle of the program...
     game.close()
-
-print()
-print("-------- starting ------------")
-main()
-sys.exit(0)
+    if trainer.memory is not None:
+        trainer.memory.close()
+    if model.checkpoint_writer is not None:
+        model.checkpoint_writer.close()
+
+
+# the spawned processes of the evaluation and the demo replay import this module again
+if __name__ == "__main__":
+    print()
+    print("-------- starting ------------")
+    main()
+    sys.exit(0)
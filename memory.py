@@ -1,34 +1,234 @@
 import numpy as np
+import json
+import os
 import random
-import tensorflow as tf
+
+
+"""
+Reward mixing of TrainerSimple (its mix_reward), the curiosity reward is weighted by 10. A plain
+function for the offline training on datasets recorded with deferred curiosity
+"""
+def mix_reward_simple(reward_model, reward_game, reward_system):
+    return 10.0*reward_model + reward_game + reward_system
 
 
 class Memory:
-    def __init__(self, n_episodes, episode_length, discount_factor=0.995):
+    demos = False # frames are stored (or their encodings), not re-rendered from demos
+
+    """
+    storage_dir: if given, the collected entries are kept in memory-mapped files in this
+    directory so that a restarted process can continue from them (see restore)
+    latent: None stores the frames, "float16" or "int8" stores only their (tanh bounded)
+    image encodings in that precision, which is about 1000x smaller
+    mix_reward: for deferred curiosity, the stored rewards leave out the curiosity reward which
+    is mixed in by set_curiosity as mix_reward(curiosity, stored reward, 0)
+    """
+    def __init__(self, n_episodes, episode_length, discount_factor=0.995, storage_dir=None,
+        restore=False, latent=None, mix_reward=None):
+        if latent not in (None, "float16", "int8"):
+            raise ValueError("Unknown latent replay precision: {}".format(latent))
+
         self.n_episodes = n_episodes
         self.episode_length = episode_length
         self.discount_factor = discount_factor
         self.state_size = 256 # model internal state size
+        self.image_enc_size = 256 # model image encoding size
+        self.storage_dir = storage_dir
+        self.latent = latent
+        self.mix_reward = mix_reward
+        self.state_image_encs = None # the encodings the states were computed from
+        # the current frame when the frames are not stored, see image_slot
+        self.frame_buffer = np.zeros((240, 320, 4), dtype=np.uint8)
+
+        if not (restore and self.restore()):
+            self.clear()
 
-        self.clear()
+
+    def allocate(self, name, shape, dtype, mode="w+"):
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.storage_dir, name + ".npy"),
+            mode=mode, shape=shape if mode == "w+" else None, dtype=dtype)
+
+
+    def allocate_observations(self, mode="w+"):
+        if self.latent is None:
+            self.images = self.allocate("images",
+                (self.episode_length, self.n_episodes, 240, 320, 4), np.uint8, mode)
+            self.image_encs = None
+        else:
+            self.images = None
+            self.image_encs = self.allocate("image_encs",
+                (self.episode_length, self.n_episodes, self.image_enc_size),
+                np.float16 if self.latent == "float16" else np.int8, mode)
+
+
+    def allocate_arrays(self, mode="w+"):
+        self.allocate_observations(mode)
+        self.actions = self.allocate("actions",
+            (self.episode_length, self.n_episodes, 15), np.float32, mode)
+        # raw per-step rewards, the discounted returns are kept separately
+        self.rewards = self.allocate("rewards",
+            (self.episode_length, self.n_episodes), np.float32, mode)
+
+        # validity mask, 1 for time steps that were actually played and 0 for the padding
+        # after a premature termination (death or level finish)
+        self.masks = self.allocate("masks",
+            (self.episode_length, self.n_episodes), np.float32, mode)
 
 
     def clear(self):
-        self.images = np.zeros((self.episode_length, self.n_episodes, 240, 320, 4), dtype=np.uint8)
-        self.actions = np.zeros((self.episode_length, self.n_episodes, 15), dtype=np.float32)
-        self.rewards = np.zeros((self.episode_length, self.n_episodes), dtype=np.float32)
+        if self.storage_dir is not None:
+            os.makedirs(self.storage_dir, exist_ok=True)
+        self.allocate_arrays()
+        self.rewards_discounted = np.zeros((self.episode_length, self.n_episodes),
+            dtype=np.float32)
 
         self.states = np.zeros((self.episode_length, self.n_episodes, self.state_size),
             dtype=np.float32)
 
         self.episode_lengths = np.zeros((self.n_episodes,), dtype=int)
+        self.episode_info = [None]*self.n_episodes # map of every episode, see begin_episode
         self.active_episode = 0
+        self.write_metadata()
+
+
+    def metadata_path(self):
+        return os.path.join(self.storage_dir, "memory.json")
+
+
+    def get_metadata(self):
+        return {
+            "n_episodes": self.n_episodes,
+            "episode_length": self.episode_length,
+            "latent": self.latent,
+            "active_episode": self.active_episode,
+            "episode_lengths": self.episode_lengths.tolist(),
+            "episode_info": self.episode_info,
+        }
 
 
+    def set_metadata(self, metadata):
+        self.episode_lengths = np.array(metadata["episode_lengths"], dtype=int)
+        self.active_episode = metadata["active_episode"]
+        self.episode_info = metadata.get("episode_info", [None]*self.n_episodes)
+
+
+    """
+    ret: True if the stored memory described by metadata can be reopened by this memory
+    """
+    def is_compatible(self, metadata):
+        return metadata["n_episodes"] == self.n_episodes and\
+            metadata["episode_length"] == self.episode_length and\
+            metadata.get("latent") == self.latent and\
+            metadata.get("demos", False) == self.demos
+
+
+    """
+    Persist the episode bookkeeping next to the memory-mapped arrays
+
+    Only finished episodes are recorded, an episode interrupted by a crash is collected again.
+    """
+    def write_metadata(self):
+        if self.storage_dir is None:
+            return
+
+        for array in (self.images, self.image_encs, self.actions, self.rewards, self.masks):
+            if array is not None:
+                array.flush()
+
+        metadata = self.get_metadata()
+        path_tmp = self.metadata_path() + ".tmp"
+        with open(path_tmp, "w") as f:
+            json.dump(metadata, f)
+        os.replace(path_tmp, self.metadata_path())
+
+
+    """
+    Reopen the memory-mapped arrays of an earlier process
+
+    ret: True if a compatible memory was found and restored
+    """
+    def restore(self):
+        if self.storage_dir is None or not os.path.exists(self.metadata_path()):
+            return False
+
+        with open(self.metadata_path()) as f:
+            metadata = json.load(f)
+        if not self.is_compatible(metadata):
+            print("Stored memory in {} has a different shape or format, discarding it".format(
+                self.storage_dir))
+            return False
+
+        self.allocate_arrays(mode="r+")
+        self.rewards_discounted = np.zeros((self.episode_length, self.n_episodes),
+            dtype=np.float32)
+        self.states = np.zeros((self.episode_length, self.n_episodes, self.state_size),
+            dtype=np.float32)
+        self.set_metadata(metadata)
+
+        if self.is_full():
+            self.discount_rewards()
+
+        print("Restored memory from {} ({}/{} episodes)".format(
+            self.storage_dir, self.active_episode, self.n_episodes))
+        return True
+
+
+    # release what is held besides the arrays (the replay workers of DemoMemory)
+    def close(self):
+        pass
+
+
+    def is_full(self):
+        return self.active_episode == self.n_episodes
+
+
+    """
+    Clear the slot of the active episode (left over from an interrupted episode)
+
+    map_info: dict with the oblige "seed", the "wad" file generated from it and the "map" name
+    ret: path to record the episode demo into, or None
+    """
+    def begin_episode(self, map_info=None):
+        self.masks[:, self.active_episode] = 0.0
+        self.episode_lengths[self.active_episode] = 0
+        if map_info is not None:
+            self.episode_info[self.active_episode] = {
+                "seed": map_info["seed"], "map": map_info["map"]}
+        return None
+
+
+    """
+    ret: (240, 320, 4) uint8 view to write the frame of time_step of the active episode into,
+    a scratch buffer if the frames are not stored
+    """
+    def image_slot(self, time_step):
+        if self.images is None:
+            return self.frame_buffer
+        return self.images[time_step, self.active_episode]
+
+
+    def store_observation(self, time_step, image):
+        if self.latent is None:
+            if image is not None:
+                self.images[time_step, self.active_episode] = image
+        elif self.latent == "int8":
+            self.image_encs[time_step, self.active_episode] = np.round(
+                np.clip(image, -1.0, 1.0)*127.0)
+        else:
+            self.image_encs[time_step, self.active_episode] = image
+
+
+    """
+    image: the (240, 320, 4) frame (None if it was written into image_slot), or its
+    (image_enc_size,) encoding in latent mode
+    """
     def store_entry(self, time_step, image, action, reward):
-        self.images[time_step, self.active_episode] = image
+        self.store_observation(time_step, image)
         self.actions[time_step, self.active_episode] = action
         self.rewards[time_step, self.active_episode] = reward
+        self.masks[time_step, self.active_episode] = 1.0
 
         # keep track of last time step for each episode due to premature termination
         # (death or level finish)
@@ -36,49 +236,115 @@ class Memory:
             max(self.episode_lengths[self.active_episode], time_step+1)
     
 
-    def discount_rewards(self):
+    def discount_rewards(self, rewards=None):
+        if rewards is None:
+            rewards = self.rewards
         # normalization parameter for rewards
         discount_scale = -np.log(self.discount_factor)
         for i in range(self.n_episodes):
             reward_cum = 0.0
-            for j in range(self.episode_length-1, -1, -1):
-                reward_cum = reward_cum*self.discount_factor + self.rewards[j, i]*discount_scale
-                self.rewards[j, i] = reward_cum
+            # rewards past the episode end stay zero
+            for j in range(self.episode_lengths[i]-1, -1, -1):
+                reward_cum = reward_cum*self.discount_factor + rewards[j, i]*discount_scale
+                self.rewards_discounted[j, i] = reward_cum
+
+
+    """
+    Mix the curiosity reward into the stored rewards and discount them again (deferred
+    curiosity, see mix_reward)
+
+    curiosity: (T, n_episodes) for the first T time steps
+    """
+    def set_curiosity(self, curiosity):
+        n_steps = curiosity.shape[0]
+        rewards = np.array(self.rewards)
+        rewards[:n_steps] = self.mix_reward(curiosity, rewards[:n_steps], 0.0)
+        self.discount_rewards(rewards)
     
 
     def finish_episode(self):
         self.active_episode += 1
 
-        memory_full = self.active_episode == self.n_episodes
+        memory_full = self.is_full()
 
         if memory_full:
             self.discount_rewards()
 
+        self.write_metadata()
+
         return memory_full
     
 
-    def compute_states(self, model_state, model_image_encoder):
-        min_episode_length = np.amin(self.episode_lengths)
-        state = tf.zeros((self.n_episodes, self.state_size))
-        for i in range(min_episode_length):
-            state = model_state([state, model_image_encoder(self.images[i], training=False)],
-                training=False).numpy()
-            self.states[i] = state
-            print("Computing states... ({}/{})".format(i, min_episode_length), end="\r")
+    """
+    Compute the model state after every stored time step
+
+    encode_images: (T, N) uint8 frames -> (T, N, image_enc_size), see Model.encode_images
+    unroll_states: (image_encs, masks) -> (T, N, state_size), see Model.unroll_states
+    """
+    def compute_states(self, encode_images, unroll_states):
+        max_episode_length = np.amax(self.episode_lengths)
+        if max_episode_length == 0:
+            return
+        if self.latent is None:
+            image_encs = self.encode_frames(encode_images, max_episode_length)
+        else:
+            image_encs = self.get_image_encs(0, max_episode_length)
+        self.states[:max_episode_length] = np.asarray(
+            unroll_states(image_encs, self.masks[:max_episode_length]))
+        self.state_image_encs = image_encs
+
+
+    """
+    ret: (length, n_episodes, image_enc_size) encodings of the frames of time steps 0...length
+    """
+    def encode_frames(self, encode_images, length):
+        return encode_images(self.get_frames(0, length))
 
 
+    """
+    ret: (length, n_episodes, 240, 320, 4) uint8 frames of time steps begin...begin+length
+    """
+    def get_frames(self, begin, length):
+        return self.images[begin:begin+length]
+
+
+    """
+    ret: stored image encodings of time steps begin...begin+length as float32 (latent mode)
+    """
+    def get_image_encs(self, begin, length):
+        import tensorflow as tf
+
+        image_encs = tf.convert_to_tensor(self.image_encs[begin:begin+length], dtype=tf.float32)
+        if self.latent == "int8":
+            image_encs *= 1.0/127.0
+        return image_encs
+
+
+    """
+    ret: (frames or, in latent mode, image encodings, actions, discounted rewards, initial
+    state, masks) of a random window of length time steps
+    """
     def get_sample(self, length):
-        min_episode_length = np.amin(self.episode_lengths)
-        begin = random.randint(0, min_episode_length-length)
+        import tensorflow as tf
+
+        # windows may extend past the end of shorter episodes, those steps are masked out
+        max_episode_length = np.amax(self.episode_lengths)
+        begin = random.randint(0, max(max_episode_length-length, 0))
 
         if begin==0:
             state = tf.zeros((self.n_episodes, self.state_size))
         else:
-            state = tf.convert_to_tensor(self.states[begin])
+            state = tf.convert_to_tensor(self.states[begin-1])
+
+        if self.latent is None:
+            inputs = tf.convert_to_tensor(self.get_frames(begin, length), dtype=tf.float32) *\
+                0.0039215686274509803
+        else:
+            inputs = self.get_image_encs(begin, length)
 
         return\
-            (tf.convert_to_tensor(self.images[begin:begin+length], dtype=tf.float32) * 0.0039215686274509803,
+            (inputs,
             tf.convert_to_tensor(self.actions[begin:begin+length]),
-            tf.convert_to_tensor(self.rewards[begin:begin+length]),
-            state)
-    
\ No newline at end of file
+            tf.convert_to_tensor(self.rewards_discounted[begin:begin+length]),
+            state,
+            tf.convert_to_tensor(self.masks[begin:begin+length]))
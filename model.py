@@ -6,15 +6,29 @@ from tensorflow.keras import initializers
 from tensorflow.keras import activations
 from tensorflow.keras import regularizers
 import random
+import os
+import contextlib
+import itertools
 from utils import *
+from progress import ProgressReporter
 from tensorflow.compat.v1 import ConfigProto
 from tensorflow.compat.v1 import InteractiveSession
 import gc
 
 
-config = ConfigProto()
-config.gpu_options.allow_growth = True
-session = InteractiveSession(config=config)
+session = None
+
+
+"""
+Create the session on first use instead of at import time
+"""
+def init_session():
+	global session
+	if session is None:
+		config = ConfigProto()
+		config.gpu_options.allow_growth = True
+		session = InteractiveSession(config=config)
+	return session
 
 
 class L2Regularizer(regularizers.Regularizer):
@@ -37,73 +51,229 @@ def loss_image(y_true, y_pred):
 	return tf.reduce_mean(tf.abs(y_true - y_pred))
 
 
-def loss_function_inverse(action_true, action_pred):
-	loss = tf.reduce_mean(tf.square(tf.math.sign(action_true[:,0:14])*0.5 - action_pred[:,0:14]))
-	loss += tf.reduce_mean(tf.abs(action_true[:,14] - action_pred[:,14]))
+"""
+Steps covered by the loss windows of one training step, shared_windows windows of length
+steps that start stride steps apart
+
+ret: (per step of the union of the windows, the number of windows containing it and the number
+of windows containing it after their first step)
+"""
+def window_coverage(shared_windows, stride, length):
+	n_steps = (shared_windows-1)*stride + length
+	starts = [k*stride for k in range(shared_windows)]
+	n_windows = [sum(1 for b in starts if b <= j < b+length) for j in range(n_steps)]
+	n_windows_after_first = [sum(1 for b in starts if b < j < b+length) for j in range(n_steps)]
+	return n_windows, n_windows_after_first
+
+
+def masked_mean(x, mask):
+	# mean over the valid (mask == 1) batch entries, zero if there are none
+	return tf.reduce_sum(x*mask) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+
+def loss_function_inverse(action_true, action_pred, mask):
+	loss = masked_mean(tf.reduce_mean(
+		tf.square(tf.math.sign(action_true[:,0:14])*0.5 - action_pred[:,0:14]), axis=-1), mask)
+	loss += masked_mean(tf.abs(action_true[:,14] - action_pred[:,14]), mask)
 	return loss
 
 
+def loss_function_reward(reward_true, reward_pred, mask):
+	return masked_mean(tf.square(reward_true - reward_pred[:,0]), mask)
+
+
+class CompiledFunction:
+	"""
+	tf.function that is XLA compiled (jit_compile) if possible
+
+	If the compilation fails, e.g. because of an op XLA does not support, the function is
+	compiled again without XLA and the failure is reported once. Only the first call can fall
+	back, errors of later calls are runtime errors and are raised.
+
+	With a distribution strategy the function runs on the replica of this process, strategy.run
+	is called inside the tf.function (apply_gradients can not synchronize from a tf.function
+	nested in strategy.run). Gradients applied in the function are all-reduced over the workers,
+	the outputs are this worker's own (local) values. Reading a batch norm statistic (ON_READ)
+	in the replica reads the local value, outside of it the read is an all-reduce, so everything
+	that only some of the workers run (acting, encoding) has to be compiled like this as well.
+	"""
+	def __init__(self, function, input_signature, jit_compile, strategy=None):
+		self.function = function
+		self.input_signature = input_signature
+		self.jit_compile = jit_compile
+		self.strategy = strategy
+		self.first_call = True
+		self.compiled = self.compile(jit_compile)
+
+	def compile(self, jit_compile):
+		function = self.function
+		if self.strategy is not None:
+			def function(*args):
+				return self.strategy.run(self.function, args=args)
+		return tf.function(function, input_signature=self.input_signature,
+			jit_compile=jit_compile)
+
+	def __call__(self, *args):
+		outputs = self.call(*args)
+		if self.strategy is None:
+			return outputs
+		return tf.nest.map_structure(
+			lambda x: self.strategy.experimental_local_results(x)[0], outputs)
+
+	def call(self, *args):
+		if not self.jit_compile or not self.first_call:
+			return self.compiled(*args)
+		try:
+			outputs = self.compiled(*args)
+			self.first_call = False
+			return outputs
+		except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError,
+			tf.errors.InternalError) as e:
+			print("XLA compilation of {} failed, running it without XLA ({})".format(
+				self.function.__name__, str(e).splitlines()[0]))
+			self.jit_compile = False
+			self.compiled = self.compile(False)
+			return self.compiled(*args)
+
+
+class GradientAccumulator:
+	"""
+	Sums the gradients of several training steps, apply updates with their mean at once
+
+	The sums are kept per replica (ON_READ), so with a distribution strategy the gradients are
+	only all-reduced once per update.
+	compile_function: Model.compile_function, the update runs on the replica like the training
+	steps
+	"""
+	def __init__(self, optimizer, variables, compile_function):
+		self.optimizer = optimizer
+		self.variables = variables
+		self.gradient_sums = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype), trainable=False,
+			synchronization=tf.VariableSynchronization.ON_READ,
+			aggregation=tf.VariableAggregation.SUM) for v in variables]
+
+		@compile_function(input_signature=[tf.TensorSpec(shape=(), dtype=tf.float32)],
+			jit_compile=False)
+		def apply(n_steps):
+			self.optimizer.apply_gradients(zip(
+				[gradient_sum.read_value() / n_steps for gradient_sum in self.gradient_sums],
+				self.variables))
+			for gradient_sum in self.gradient_sums:
+				gradient_sum.assign(tf.zeros_like(gradient_sum))
+
+		self.apply = apply
+
+	def accumulate(self, gradients):
+		for gradient_sum, gradient in zip(self.gradient_sums, gradients):
+			if gradient is not None:
+				gradient_sum.assign_add(gradient)
+
+
 class ActionModel:
 	def __init__(self, model):
 		self.model_state = model.model_state
 		self.model_encoding = model.model_encoding
 		self.model_reward = model.model_reward
 
-		self.tbptt_length_action = model.tbptt_length_action
 		self.action_optimizer = model.action_optimizer
+		self.gradient_scale = model.gradient_scale
 
 		self.create_action_model(model)
 
-		@tf.function(input_signature=[
-			tf.TensorSpec(shape=(model.replay_sample_length, 8, model.image_enc_size), dtype=tf.float32),
-			tf.TensorSpec(shape=(model.replay_sample_length, 8, 15), dtype=tf.float32),
-			tf.TensorSpec(shape=(model.replay_sample_length, 8), dtype=tf.float32),
-			tf.TensorSpec(shape=(8, model.state_size), dtype=tf.float32),
+		# compiled training functions per training configuration, see Model.get_training_config
+		self.train_functions = {}
+		self.train = None
+		# greedy action of a (1, state_size) state while playing
+		self.predict = model.compile_function(input_signature=[
+			tf.TensorSpec(shape=(1, model.state_size), dtype=tf.float32)
+		])(lambda state: self.model_action(state, training=False))
+
+	"""
+	Use the training function of the model's current configuration, compile it on first use
+	"""
+	def select_train_function(self, model):
+		config = model.get_training_config()
+		if config not in self.train_functions:
+			self.train_functions[config] = self.define_train_function(model)
+		self.train = self.train_functions[config]
+		# the windows of a step are batched, keras divides the activity regularization by the
+		# whole batch
+		self.regularizer.batch_size.assign(float(model.batch_size*model.shared_windows))
+
+	def define_train_function(self, model):
+		batch_size = model.batch_size
+		tbptt_length_action = model.tbptt_length_action
+		window_stride_action = model.window_stride_action
+		shared_windows = model.shared_windows
+
+		# one step of the imagined rollout, returns the activity regularization of the action
+		def rollout_step(image_enc, state, action):
+			image_enc = self.model_encoding([image_enc, state, action], training=False)
+			state = self.model_state([state, image_enc], training=False)
+			action = self.model_action(state, training=True)
+			reward = self.model_reward([state, action], training=True)
+			return image_enc, state, action, reward, self.model_action.losses[0]
+		rollout_step = model.checkpoint_step(rollout_step)
+
+		@model.compile_function(input_signature=[
+			tf.TensorSpec(shape=(model.replay_sample_length, batch_size, model.image_enc_size),
+				dtype=tf.float32),
+			tf.TensorSpec(shape=(model.replay_sample_length, batch_size, 15), dtype=tf.float32),
+			tf.TensorSpec(shape=(model.replay_sample_length, batch_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(batch_size, model.state_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(model.replay_sample_length, batch_size), dtype=tf.float32),
 			tf.TensorSpec(shape=(), dtype=tf.int32),
 			tf.TensorSpec(shape=(), dtype=tf.float32)
 		])
-		def train(image_encs, actions, rewards, state_init, i, discount_factor):
+		def train(image_encs, actions, rewards, state_init, masks, i, discount_factor):
 			discount_falloff = 1.0 # iterative discount factor
 			discount_cum = 0.0
-			state = self.model_state([state_init, image_encs[i]], training=False)
-			with tf.GradientTape(persistent=True) as gt:
+			# the rollouts of all windows of this step (starting at i + k*window_stride_action)
+			# are run side by side as one batch
+			starts = [k*window_stride_action for k in range(shared_windows)]
+			states = model.unroll_window_states(image_encs, state_init, i,
+				shared_windows*window_stride_action)
+			state = tf.concat([states[start+1] for start in starts], axis=0)
+			mask = tf.concat([masks[i+start] for start in starts], axis=0)
+			with tf.GradientTape() as gt:
 				action = self.model_action(state, training=True)
 				reward = self.model_reward([state, action], training=True)
-				image_enc = image_encs[i]
+				image_enc = tf.concat([image_encs[i+start] for start in starts], axis=0)
 
-				reward_mean = tf.reduce_mean(reward)
+				# imagined rollouts are only started from valid time steps
+				reward_mean = masked_mean(reward[:,0], mask)
 				loss_reward = -reward_mean
 				loss_reg = 2.0*tf.math.pow(self.model_action.losses[0], 4.0)*tf.abs(reward_mean)
 
 				# simulate forward and predict rewards
-				for j in range(1, self.tbptt_length_action):
-					image_enc = self.model_encoding([image_enc, state, action], training=False)
-					state = self.model_state([state, image_enc], training=False)
-					action = self.model_action(state, training=True)
-					reward = self.model_reward([state, action], training=True)
+				for j in range(1, tbptt_length_action):
+					image_enc, state, action, reward, action_reg = rollout_step(image_enc, state,
+						action)
 
-					reward_mean = tf.reduce_mean(reward)
+					reward_mean = masked_mean(reward[:,0], mask)
 					loss_reward -= reward_mean*discount_falloff
-					loss_reg += 2.0*tf.math.pow(self.model_action.losses[0], 4.0)*\
-						tf.abs(reward_mean)*discount_falloff
+					loss_reg += 2.0*tf.math.pow(action_reg, 4.0)*tf.abs(reward_mean)*discount_falloff
 					
 					discount_cum += discount_falloff
 					discount_falloff *= discount_factor # update dc. falloff according to dc. factor
 				
 				loss_total = (loss_reward + loss_reg) / discount_cum
+				# scaled while recording, the product has to be on the tape
+				loss_scaled = loss_total*self.gradient_scale
 
 			
-			g_model_action = gt.gradient(loss_total, self.model_action.trainable_variables)
+			g_model_action = gt.gradient(loss_scaled, self.model_action.trainable_variables)
 			
 			self.action_optimizer.apply_gradients(zip(g_model_action,
 				self.model_action.trainable_variables))
 			
-			state = self.model_state([state_init, image_encs[i]], training=False)
+			# state before the first window of the next step
+			state = states[-1]
 			
-			l_norm = 1.0 / self.tbptt_length_action
+			l_norm = 1.0 / tbptt_length_action
 			return state, loss_total*l_norm, loss_reward*l_norm, loss_reg*l_norm
 		
-		self.train = train
+		return train
 	
 
 	def create_action_model(self, model):
@@ -111,9 +281,10 @@ class ActionModel:
 
 		x = model.module_dense(self.model_action_i_state, model.state_size, n2=model.state_size)
 
+		self.regularizer = MaxRegularizer(batch_size=float(model.batch_size))
 		self.model_action_o_action = layers.Dense(15,
 			kernel_initializer=model.initializer, 
-			activity_regularizer=MaxRegularizer(), use_bias=False, activation="tanh")(x)
+			activity_regularizer=self.regularizer, use_bias=False, activation="tanh")(x)
 		
 		self.model_action = keras.Model(
 			inputs=self.model_action_i_state,
@@ -135,127 +306,371 @@ class ActionModel:
 
 
 class Model:
-	def __init__(self, episode_length, n_replay_episodes, n_training_epochs, replay_sample_length):
+	"""
+	batch_size: episodes per training batch on this process, defaults to n_replay_episodes
+	tbptt_length_*: unroll lengths of the encoder, backbone and action model training steps
+	recompute_grad: recompute the activations of every unroll step in the backward pass instead
+	of keeping them, trades compute for peak training memory
+	encode_chunk_size: frames per image encoder call when encoding whole episodes, bounded by
+	the memory of the encoder activations
+	jit_compile: XLA compile the training steps and the per-step inference
+	accumulation_steps: window starts whose gradients are summed before each update of the
+	image encoder phase (inverse model) and of the backbone, the effective batch size
+	window_stride_*: steps between the starts of consecutive training windows of the encoder,
+	backbone and action model phases, 1 trains on a window starting at every time step
+	shared_windows: windows per training step (and update). The encoder phase serves them all
+	with a single teacher-forced unroll over their union, the backbone and the action models
+	run their unrolls side by side as one batch.
+	strategy: tf.distribute strategy for data-parallel training over several processes
+	(see distributed.py), None trains locally
+	"""
+	def __init__(self, episode_length, n_replay_episodes, n_training_epochs, replay_sample_length,
+		batch_size=None, strategy=None, tbptt_length_encoder=8, tbptt_length_backbone=32,
+		tbptt_length_action=16, recompute_grad=False, encode_chunk_size=256, jit_compile=False,
+		accumulation_steps=1, window_stride_encoder=1, window_stride_backbone=1,
+		window_stride_action=1, shared_windows=1):
+		init_session()
+
+		self.strategy = strategy
+		self.is_chief = True # only the chief writes checkpoints
+		# apply_gradients sums the gradients over the replicas, scale to get their mean
+		self.gradient_scale = 1.0 / self.get_num_replicas()
+
 		self.initializer = initializers.RandomNormal(stddev=0.02)
-		self.optimizer = keras.optimizers.Adam(learning_rate=0.0001, beta_1=0.9, beta_2=0.999)
-		self.action_optimizer = keras.optimizers.Adam(learning_rate=0.0001, beta_1=0.9, beta_2=0.999)
 		self.loss_function = keras.losses.MeanSquaredError()
 		self.loss_image = loss_image
 		#self.loss_action = loss_action
 
 		self.state_size = 256
 		self.image_enc_size = 256
-		self.tbptt_length_encoder = 8
-		self.tbptt_length_backbone = 32
-		self.tbptt_length_action = 16
+		self.tbptt_length_encoder = tbptt_length_encoder
+		self.tbptt_length_backbone = tbptt_length_backbone
+		self.tbptt_length_action = tbptt_length_action
+		self.recompute_grad = recompute_grad
+		self.encode_chunk_size = encode_chunk_size
+		self.jit_compile = jit_compile
+		self.accumulation_steps = accumulation_steps
+		self.window_stride_encoder = window_stride_encoder
+		self.window_stride_backbone = window_stride_backbone
+		self.window_stride_action = window_stride_action
+		self.shared_windows = shared_windows
 
 		self.reset_state()
+		# adapted by every search, this process' own (not mirrored, it is updated on the replica)
 		self.action_predict_step_size = tf.Variable(0.01)
+		self.action_search_iterations = 10
+		self.search_worst_actions = None # compiled on first use
 		self.episode_length = episode_length
 		self.n_replay_episodes = n_replay_episodes
 		self.n_training_epochs = n_training_epochs
 		self.replay_sample_length = replay_sample_length
+		self.batch_size = batch_size if batch_size is not None else n_replay_episodes
+		for tbptt_length, stride in ((tbptt_length_encoder, window_stride_encoder),
+			(tbptt_length_backbone, window_stride_backbone), (0, window_stride_action)):
+			if len(self.window_starts(tbptt_length, stride)) == 0:
+				raise ValueError("No training window of length {} fits into a replay sample of "
+					"length {} with {} shared windows {} steps apart".format(tbptt_length,
+					replay_sample_length, shared_windows, stride))
+
+		# variables have to be created under the strategy scope to be mirrored
+		with self.strategy_scope():
+			self.optimizer = keras.optimizers.Adam(learning_rate=0.0001, beta_1=0.9, beta_2=0.999)
+			self.action_optimizer = keras.optimizers.Adam(learning_rate=0.0001, beta_1=0.9,
+				beta_2=0.999)
+
+			self.create_image_encoder_model(feature_multiplier=2)
+
+			self.create_state_model()
+			self.create_reward_model()
+			self.create_encoding_model()
+			self.create_action_models()
+
+		# the decoder and the inverse model are not needed for playing, they are built on
+		# first access (see the properties below)
+		self._model_image_decoder = None
+		self._model_inverse = None
+
+		# compiled training functions per training configuration, the ones of the current
+		# configuration are selected (and traced on first use) by train
+		self.training_functions = {}
+		self.train_image_encoder_model = None
+		self.train_backbone = None
+		# gradient sums of the current configuration, None without accumulation
+		self.accumulator_inverse = None
+		self.accumulator_backbone = None
+		# batched encoding of many frames and the state recurrence over the encodings
+		self.encode_chunk = None
+		self.unroll_states_function = None
+		# per-step inference while playing (with and without the curiosity prediction),
+		# compiled on first use
+		self.advance_step = None
+		self.advance_step_encode = None
+		self.predict_encodings_function = None
+		# autoencoder pretraining step of the image encoder, compiled on first use
+		self.train_autoencoder_step = None
+
+		# console progress of the training loops, refreshed at most 4 times per second
+		self.reporter = ProgressReporter()
+
+		# background writer for single-file checkpoints, see checkpoint.py
+		self.checkpoint_writer = None
+		# optional callable returning additional checkpoint entries (trainer counters, rng)
+		self.checkpoint_extra_state = None
+
+
+	def get_num_replicas(self):
+		if self.strategy is None:
+			return 1
+		return self.strategy.num_replicas_in_sync
+
+	def strategy_scope(self):
+		if self.strategy is None:
+			return contextlib.nullcontext()
+		return self.strategy.scope()
+
+	@property
+	def model_image_decoder(self):
+		if self._model_image_decoder is None:
+			with self.strategy_scope():
+				self.create_image_decoder_model(feature_multiplier=2)
+		return self._model_image_decoder
+
+	@property
+	def model_inverse(self):
+		if self._model_inverse is None:
+			with self.strategy_scope():
+				self.create_inverse_model()
+		return self._model_inverse
 
-		self.create_image_encoder_model(feature_multiplier=2)
-		self.create_image_decoder_model(feature_multiplier=2)
 
-		self.create_state_model()
-		self.create_reward_model()
-		self.create_encoding_model()
-		self.create_inverse_model()
-		self.create_action_models()
+	"""
+	ret: hashable key of everything the compiled training functions depend on
+	"""
+	def get_training_config(self):
+		return (self.batch_size, self.replay_sample_length, self.tbptt_length_encoder,
+			self.tbptt_length_backbone, self.tbptt_length_action, self.recompute_grad,
+			self.jit_compile, self.accumulation_steps, self.window_stride_encoder,
+			self.window_stride_backbone, self.window_stride_action, self.shared_windows)
 
-		self.define_training_functions()
+	"""
+	Decorator compiling a function with tf.function, with XLA if jit_compile is enabled (and not
+	disabled for the function), run on the replica of this process with a strategy
+	"""
+	def compile_function(self, input_signature, jit_compile=True):
+		return lambda function: CompiledFunction(function, input_signature,
+			self.jit_compile and jit_compile, self.strategy)
 
+	"""
+	Gradient checkpointing of an unroll step (if recompute_grad is enabled)
 
-	def define_training_functions(self):
+	The step must return everything the loss needs from it, including the activity
+	regularization losses, as tensors created inside the step do not exist in the backward
+	pass. The batch norm statistics are updated again when the step is recomputed.
+	"""
+	def checkpoint_step(self, step):
+		if not self.recompute_grad:
+			return step
+		return tf.recompute_grad(step)
+
+	"""
+	Use the training functions of the current configuration, compile them on first use
+
+	Changing batch_size or a tbptt length between calls to train only retraces for
+	configurations that have not been used before.
+	"""
+	def select_training_functions(self):
+		config = self.get_training_config()
+		if config not in self.training_functions:
+			self.training_functions[config] = self.define_training_functions()
+		self.train_image_encoder_model, self.train_backbone, self.accumulator_inverse,\
+			self.accumulator_backbone = self.training_functions[config]
+		for model_action in self.models_action:
+			model_action.select_train_function(self)
+
+	"""
+	Update from the accumulated gradients after every accumulation_steps steps and after the
+	last step of a phase
+
+	i: index of the step that was just run, n: number of steps in the phase
+	"""
+	def apply_accumulated(self, accumulator, i, n):
+		if accumulator is None:
+			return
+		n_accumulated = i % self.accumulation_steps + 1
+		if n_accumulated == self.accumulation_steps or i == n-1:
+			accumulator.apply(tf.constant(float(n_accumulated)))
+
+	"""
+	ret: first window start of every training step of a phase, each step trains on
+	shared_windows windows of length tbptt_length starting stride steps apart (and advances the
+	state over shared_windows*stride steps)
+	"""
+	def window_starts(self, tbptt_length, stride):
+		end = min(self.replay_sample_length - tbptt_length - (self.shared_windows-1)*stride,
+			self.replay_sample_length - self.shared_windows*stride + 1)
+		return range(0, end, self.shared_windows*stride)
+
+	"""
+	Teacher-forced states of the window starts of a training step, without gradients
 
-		@tf.function(input_signature=[
-			tf.TensorSpec(shape=(self.replay_sample_length, 8, 240, 320, 4), dtype=tf.float32),
-			tf.TensorSpec(shape=(self.replay_sample_length, 8, 15), dtype=tf.float32),
-			tf.TensorSpec(shape=(self.replay_sample_length, 8), dtype=tf.float32),
-			tf.TensorSpec(shape=(8, self.state_size), dtype=tf.float32),
+	ret: list of the n_steps+1 states before the time steps i...i+n_steps
+	"""
+	def unroll_window_states(self, image_encs, state_init, i, n_steps):
+		states = [state_init]
+		for t in range(n_steps):
+			states.append(self.model_state([states[-1], image_encs[i+t]], training=False))
+		return states
+
+	"""
+	ret: (train_image_encoder_model, train_backbone, accumulator_inverse, accumulator_backbone)
+	for the current configuration
+	"""
+	def define_training_functions(self):
+		# build the lazy inverse model eagerly, not while tracing the training function
+		self.model_inverse
+		variables_inverse = self.model_inverse.trainable_variables
+		variables_backbone = self.model_encoding.trainable_variables +\
+			self.model_state.trainable_variables + self.model_reward.trainable_variables
+		accumulator_inverse = None
+		accumulator_backbone = None
+		if self.accumulation_steps > 1:
+			with self.strategy_scope():
+				accumulator_inverse = GradientAccumulator(self.optimizer, variables_inverse,
+					self.compile_function)
+				accumulator_backbone = GradientAccumulator(self.optimizer, variables_backbone,
+					self.compile_function)
+		batch_size = self.batch_size
+		tbptt_length_encoder = self.tbptt_length_encoder
+		tbptt_length_backbone = self.tbptt_length_backbone
+		window_stride_encoder = self.window_stride_encoder
+		window_stride_backbone = self.window_stride_backbone
+		shared_windows = self.shared_windows
+		n_windows_encoder, n_windows_after_first_encoder = window_coverage(shared_windows,
+			window_stride_encoder, tbptt_length_encoder)
+
+		# one encoder step, returns the regularization losses of the encoder and state models
+		def encoder_step(image, state, action):
+			image_enc = self.model_image_encoder(image, training=True)
+			state = self.model_state([state, image_enc], training=True)
+			reward = self.model_reward([state, action], training=True)
+			return state, reward, self.model_image_encoder.losses[0] + self.model_state.losses[0]
+
+		# one step of the backbone unroll, returns the regularization loss of the state model
+		def backbone_step(image_enc, state, action_prev, action):
+			image_enc = self.model_encoding([image_enc, state, action_prev], training=True)
+			state = self.model_state([state, image_enc], training=True)
+			reward = self.model_reward([state, action], training=True)
+			return image_enc, state, reward, self.model_state.losses[0]
+		backbone_step = self.checkpoint_step(backbone_step)
+
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size, 240, 320, 4),
+				dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size, 15), dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(batch_size, self.state_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size), dtype=tf.float32),
 			tf.TensorSpec(shape=(), dtype=tf.int32)
 		])
-		def train_image_encoder_model(images, actions, rewards, state_init, i):
-			with tf.GradientTape(persistent=True) as gt:
-				image_enc = self.model_image_encoder(images[i], training=True)
-				state= self.model_state([state_init, image_enc], training=True)
-				reward = self.model_reward([state, actions[i]], training=True)
-
-				loss_total = self.loss_function(rewards[i], reward)
-				loss_total = self.model_image_encoder.losses[0] + self.model_state.losses[0]
+		def train_image_encoder_model(images, actions, rewards, state_init, masks, i):
+			# all windows of this step (starting at i + k*window_stride_encoder) are teacher forced,
+			# so a single unroll over their union serves all of them, the loss of every step is
+			# weighted by the number of windows containing it. The unroll also runs on to the
+			# start of the first window of the next step, its state there is returned (the state
+			# of the unroll in training mode, like the states the windows start from).
+			n_steps_next = shared_windows*window_stride_encoder
+			with tf.GradientTape() as gt:
+				# only the inverse model is trained in this phase, so the encoder passes are not
+				# recorded and their activations are freed right away. They still run in training
+				# mode, the batch norm statistics of the encoder are updated here
+				with gt.stop_recording():
+					state, reward, loss_reg = encoder_step(images[i], state_init, actions[i])
+				state_next = state
+
+				loss_total = loss_reg
 				loss_inverse = tf.zeros_like(loss_total)
 
-				for j in range(1, self.tbptt_length_encoder):
+				for j in range(1, max(len(n_windows_encoder), n_steps_next)):
 					# image_enc_prev = image_enc
 					state_prev = state
-					image_enc = self.model_image_encoder(images[i+j], training=True)
-					state= self.model_state([state, image_enc], training=True)
-					reward = self.model_reward([state, actions[i+j]], training=True)
+					with gt.stop_recording():
+						state, reward, loss_reg = encoder_step(images[i+j], state, actions[i+j])
+					if j == n_steps_next - 1:
+						state_next = state
+					if j >= len(n_windows_encoder) or n_windows_encoder[j] == 0:
+						continue
+					loss_total += loss_reg * n_windows_encoder[j]
+					if n_windows_after_first_encoder[j] == 0:
+						continue
 					# action_pred = self.model_inverse([image_enc_prev, image_enc], training=True)
 					action_pred = self.model_inverse([state_prev, state], training=True)
 
 					# reward loss
-					loss_total += self.loss_function(rewards[i+j], reward)
-					# regularization loss
-					loss_total += self.model_image_encoder.losses[0] + self.model_state.losses[0]
+					loss_total += loss_function_reward(rewards[i+j], reward, masks[i+j]) *\
+						n_windows_after_first_encoder[j]
 					# inverse loss
-					loss_inverse += loss_function_inverse(actions[i+j], action_pred)
+					loss_inverse += loss_function_inverse(actions[i+j], action_pred, masks[i+j]) *\
+						n_windows_after_first_encoder[j]
 
 				#loss_total += loss_inverse
+				loss_total /= shared_windows
+				loss_inverse /= shared_windows
+				# scaled while recording, the product has to be on the tape
+				loss_scaled = loss_inverse*self.gradient_scale
 			
-			# g_model_image_encoder = gt.gradient(loss_total, self.model_image_encoder.trainable_variables)
-			# g_model_state = gt.gradient(loss_total, self.model_state.trainable_variables)
-			# g_model_reward = gt.gradient(loss_total, self.model_reward.trainable_variables)
-			
-			g_model_state = gt.gradient(loss_inverse, self.model_state.trainable_variables)
-			g_model_inverse = gt.gradient(loss_inverse, self.model_inverse.trainable_variables)
+			g_model_inverse = gt.gradient(loss_scaled, variables_inverse)
 		
-			# self.optimizer.apply_gradients(zip(g_model_image_encoder,
-			# 	self.model_image_encoder.trainable_variables))
-			# self.optimizer.apply_gradients(zip(g_model_state,
-			# 	self.model_state.trainable_variables))
-			# self.optimizer.apply_gradients(zip(g_model_reward,
-			# 	self.model_reward.trainable_variables))
-			self.optimizer.apply_gradients(zip(g_model_inverse,
-				self.model_inverse.trainable_variables))
-			
-			state = self.model_state([state_init, self.model_image_encoder(images[i],
-				training=False)], training=False)
+			if accumulator_inverse is None:
+				self.optimizer.apply_gradients(zip(g_model_inverse, variables_inverse))
+			else:
+				accumulator_inverse.accumulate(g_model_inverse)
 			
-			l_norm = 1.0 / self.tbptt_length_encoder
-			return state, loss_total*l_norm, loss_inverse*l_norm
+			l_norm = 1.0 / tbptt_length_encoder
+			return state_next, loss_total*l_norm, loss_inverse*l_norm
 
 
-		@tf.function(input_signature=[
-			tf.TensorSpec(shape=(self.replay_sample_length, 8, self.image_enc_size), dtype=tf.float32),
-			tf.TensorSpec(shape=(self.replay_sample_length, 8, 15), dtype=tf.float32),
-			tf.TensorSpec(shape=(self.replay_sample_length, 8), dtype=tf.float32),
-			tf.TensorSpec(shape=(8, self.state_size), dtype=tf.float32),
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size, self.image_enc_size),
+				dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size, 15), dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(batch_size, self.state_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(self.replay_sample_length, batch_size), dtype=tf.float32),
 			tf.TensorSpec(shape=(), dtype=tf.int32)
 		])
-		def train_backbone(image_encs, actions, rewards, state_init, i):
+		def train_backbone(image_encs, actions, rewards, state_init, masks, i):
 			discount_factor = 1.0
 			discount_cum = 0.0
-			with tf.GradientTape(persistent=True) as gt:
-				state = self.model_state([state_init, image_encs[i]], training=True)
-				reward = self.model_reward([state, actions[i]], training=True)
-				image_enc = image_encs[i]
-
-				loss_total = self.model_image_encoder.losses[0] + self.model_state.losses[0]
-				loss_reward = self.loss_function(rewards[i], reward)
+			# the windows of this step (starting at i + k*window_stride_backbone) are unrolled
+			# side by side as one batch, from their teacher-forced start states
+			starts = [k*window_stride_backbone for k in range(shared_windows)]
+			states = self.unroll_window_states(image_encs, state_init, i,
+				shared_windows*window_stride_backbone)
+			def windows(x, j):
+				return tf.concat([x[i+start+j] for start in starts], axis=0)
+
+			with tf.GradientTape() as gt:
+				state = self.model_state([tf.concat([states[start] for start in starts], axis=0),
+					windows(image_encs, 0)], training=True)
+				reward = self.model_reward([state, windows(actions, 0)], training=True)
+				image_enc = windows(image_encs, 0)
+
+				# the image encoder does not run in this function, its regularization loss would
+				# be a tensor of another graph
+				loss_total = self.model_state.losses[0]
+				loss_reward = loss_function_reward(windows(rewards, 0), reward, windows(masks, 0))
 				loss_encoding = tf.zeros_like(loss_reward)
 
-				for j in range(1, self.tbptt_length_backbone):
-					image_enc = self.model_encoding([image_enc, state, actions[i+j-1]], training=True)
-					state = self.model_state([state, image_enc], training=True)
-					reward = self.model_reward([state, actions[i+j]], training=True)
+				for j in range(1, tbptt_length_backbone):
+					image_enc, state, reward, loss_reg_state = backbone_step(image_enc, state,
+						windows(actions, j-1), windows(actions, j))
 
-					loss_enc_iter = tf.reduce_mean(tf.abs(image_encs[i+j] - image_enc))
+					mask = windows(masks, j)
+					loss_enc_iter = masked_mean(
+						tf.reduce_mean(tf.abs(windows(image_encs, j) - image_enc), axis=-1), mask)
 					loss_encoding += loss_enc_iter * discount_factor
-					loss_reward += self.loss_function(rewards[i+j], reward) * discount_factor
-					loss_total += self.model_image_encoder.losses[0] + self.model_state.losses[0]
+					loss_reward += loss_function_reward(windows(rewards, j), reward, mask) * discount_factor
+					loss_total += loss_reg_state
 
 					# discount falloff according to prediction error
 					discount_cum += discount_factor
@@ -265,24 +680,23 @@ class Model:
 				loss_reward /= discount_cum # normalize by cumulative discount
 				loss_encoding /= discount_cum
 				loss_total += loss_reward + loss_encoding
+				# scaled while recording, the product has to be on the tape
+				loss_scaled = loss_total*self.gradient_scale
 			
-			g_model_encoding = gt.gradient(loss_total, self.model_encoding.trainable_variables)
-			g_model_state = gt.gradient(loss_total, self.model_state.trainable_variables)
-			g_model_reward = gt.gradient(loss_total, self.model_reward.trainable_variables)
+			# a single backward pass and a single update for all three models
+			gradients = gt.gradient(loss_scaled, variables_backbone)
 		
-			self.optimizer.apply_gradients(zip(g_model_encoding,
-				self.model_encoding.trainable_variables))
-			self.optimizer.apply_gradients(zip(g_model_state,
-				self.model_state.trainable_variables))
-			self.optimizer.apply_gradients(zip(g_model_reward,
-				self.model_reward.trainable_variables))
+			if accumulator_backbone is None:
+				self.optimizer.apply_gradients(zip(gradients, variables_backbone))
+			else:
+				accumulator_backbone.accumulate(gradients)
 			
-			state = self.model_state([state_init, image_encs[i]], training=False)
-			return state, loss_total, loss_reward, loss_encoding, discount_cum
+			# state before the first window of the next step
+			return states[-1], loss_total, loss_reward, loss_encoding, discount_cum
 		
 
-		self.train_image_encoder_model = train_image_encoder_model
-		self.train_backbone = train_backbone
+		return train_image_encoder_model, train_backbone, accumulator_inverse,\
+			accumulator_backbone
 
 	
 	def module_dense(self, x, n, x2=None, n2=None, alpha=0.001, act=None):
@@ -447,7 +861,7 @@ class Model:
 		self.model_image_decoder_o_image = self.module_deconv(x, 8*feature_multiplier, 4,
 			act=layers.Activation(activations.sigmoid), k2=(3,3), alpha=1.0e-6)
 
-		self.model_image_decoder = keras.Model(
+		self._model_image_decoder = keras.Model(
 			inputs=self.model_image_decoder_i_image_enc,
 			outputs=self.model_image_decoder_o_image,
 			name="model_image_decoder")
@@ -545,7 +959,7 @@ class Model:
 		self.model_inverse_o_action = layers.Dense(15,
 			kernel_initializer=self.initializer, use_bias=False, activation="tanh")(x)
 
-		self.model_inverse = keras.Model(
+		self._model_inverse = keras.Model(
 			inputs=[self.model_inverse_i_state1, self.model_inverse_i_state2],
 			outputs=self.model_inverse_o_action,
 			name="model_inverse")
@@ -558,21 +972,94 @@ class Model:
 			self.models_action.append(ActionModel(self))
 
 
-	def advance(self, image, action_prev):
-		# preprocess image and previous action
-		image = tf.convert_to_tensor(image, dtype=tf.float32) * 0.0039215686274509803 # 1/255
-		action_prev = tf.expand_dims(action_prev,0)
+	def define_advance_function(self):
+		input_signature = [
+			tf.TensorSpec(shape=(240, 320, 4), dtype=tf.uint8),
+			tf.TensorSpec(shape=(15,), dtype=tf.float32),
+			tf.TensorSpec(shape=(1, self.image_enc_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(1, self.state_size), dtype=tf.float32)
+		]
+
+		def encode_step(image, state):
+			# update image encoding and state, the frame is normalized here instead of on the host
+			image = tf.cast(tf.expand_dims(image, 0), tf.float32) * 0.0039215686274509803 # 1/255
+			image_enc = self.model_image_encoder(image, training=False)
+			state = self.model_state([state, image_enc], training=False)
+			return image_enc, state
+
+		@self.compile_function(input_signature=input_signature)
+		def advance_step(image, action_prev, image_enc, state):
+			# predict encoding from previous image encoding and state
+			image_enc_pred = self.model_encoding([
+				image_enc, state, tf.expand_dims(action_prev, 0)], training=False)
+
+			image_enc, state = encode_step(image, state)
 
-		# predict encoding from previous image encoding and state
-		image_enc_pred = self.model_encoding([
-			self.image_enc, self.state, action_prev], training=False)
+			# curiosity reward - difference between predicted and real image encoding
+			return image_enc, state, tf.reduce_mean(tf.abs(image_enc[0] - image_enc_pred[0]))
 
-		# update image encoding and state
-		self.image_enc = self.model_image_encoder(tf.expand_dims(image, 0), training=False)
-		self.state = self.model_state([self.state, self.image_enc], training=False)
+		@self.compile_function(input_signature=input_signature)
+		def advance_step_encode(image, action_prev, image_enc, state):
+			return encode_step(image, state)
 
-		# return curiosity reward - difference between predicted and real image encoding
-		return tf.reduce_mean(tf.abs(self.image_enc[0] - image_enc_pred[0]))
+		self.advance_step = advance_step
+		self.advance_step_encode = advance_step_encode
+
+	"""
+	image: (240, 320, 4) uint8 frame, e.g. a view of the replay memory slot
+	curiosity: False skips the encoding prediction, for curiosity computed after the episode
+	(see compute_curiosity)
+	ret: curiosity reward, None if not computed
+	"""
+	def advance(self, image, action_prev, curiosity=True):
+		if self.advance_step is None:
+			self.define_advance_function()
+
+		inputs = (tf.convert_to_tensor(image, dtype=tf.uint8),
+			tf.convert_to_tensor(action_prev, dtype=tf.float32), self.image_enc, self.state)
+		if not curiosity:
+			self.image_enc, self.state = self.advance_step_encode(*inputs)
+			return None
+
+		self.image_enc, self.state, curiosity = self.advance_step(*inputs)
+		return curiosity
+
+	"""
+	Curiosity reward of every stored time step, in one batch
+
+	Same as the one returned by advance while playing, but with the current encoding model.
+	Needs the encodings and states of memory.compute_states.
+	ret: (T, n_episodes) array for the first T time steps, zero for the masked steps
+	"""
+	def compute_curiosity(self, memory):
+		if self.predict_encodings_function is None:
+			self.predict_encodings_function = self.compile_function(input_signature=[
+				tf.TensorSpec(shape=(None, self.image_enc_size), dtype=tf.float32),
+				tf.TensorSpec(shape=(None, self.state_size), dtype=tf.float32),
+				tf.TensorSpec(shape=(None, 15), dtype=tf.float32)
+			], jit_compile=False)(lambda image_enc, state, action: self.model_encoding(
+				[image_enc, state, action], training=False))
+
+		image_encs = tf.convert_to_tensor(memory.state_image_encs, dtype=tf.float32)
+		n_steps, n_episodes = image_encs.shape[0], image_encs.shape[1]
+		states = tf.convert_to_tensor(memory.states[:n_steps])
+		actions = tf.convert_to_tensor(memory.actions[:n_steps], dtype=tf.float32)
+
+		# inputs of the prediction of step t, an episode starts from zeros and the null action
+		image_encs_prev = tf.concat([tf.zeros_like(image_encs[0:1]), image_encs[:-1]], axis=0)
+		states_prev = tf.concat([tf.zeros_like(states[0:1]), states[:-1]], axis=0)
+		actions_prev = tf.concat([
+			tf.tile(tf.convert_to_tensor(get_null_action(), dtype=tf.float32)[None,None],
+			(1, n_episodes, 1)), actions[:-1]], axis=0)
+
+		n = n_steps*n_episodes
+		image_encs_pred = self.predict_encodings_function(
+			tf.reshape(image_encs_prev, (n, self.image_enc_size)),
+			tf.reshape(states_prev, (n, self.state_size)),
+			tf.reshape(actions_prev, (n, 15)))
+		curiosity = tf.reduce_mean(tf.abs(
+			tf.reshape(image_encs, (n, self.image_enc_size)) - image_encs_pred), axis=-1)
+		return tf.reshape(curiosity, (n_steps, n_episodes)).numpy() * memory.masks[:n_steps]
 
 	"""
 	Reset state (after an episode)
@@ -587,155 +1074,399 @@ class Model:
 	def predict_action(self, model_id, epsilon=0.0):
 		state_input = (1.0-epsilon)*self.state +\
 			epsilon*tf.random.uniform((1, self.state_size), -1.0, 1.0)
-		action = self.models_action[model_id](state_input, training=False)[0]
+		action = self.models_action[model_id].predict(state_input)[0]
 
 		return action.numpy()
 
+	"""
+	Projected gradient search for the actions with the lowest predicted reward
+
+	The whole search runs in one graph for a batch of states. The search stops early once no
+	action component moves more than tolerance in an iteration.
+	"""
+	def define_action_search_function(self):
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(None, self.state_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(), dtype=tf.int32),
+			tf.TensorSpec(shape=(), dtype=tf.float32)
+		], jit_compile=False)
+		def search_worst_actions(states, n_iterations, tolerance):
+			step_size = self.action_predict_step_size.read_value()
+			actions = tf.random.normal((tf.shape(states)[0], 15), mean=0.0, stddev=0.01)
+			# largest unclipped step proposal, the step size adapts to it
+			action_max = tf.math.reduce_max(tf.abs(actions))
+
+			for i in tf.range(n_iterations):
+				with tf.GradientTape() as g:
+					g.watch(actions)
+					reward = self.model_reward([states, actions], training=False)
+				action_grad = g.gradient(reward, actions)
+				# the rewards are independent, so each row holds the gradient of its own state
+				action_grad /= tf.math.reduce_std(action_grad, axis=-1, keepdims=True) + 1e-8
+				actions_proposed = actions - action_grad*step_size
+				action_max = tf.math.reduce_max(tf.abs(actions_proposed))
+				actions_next = tf.clip_by_value(actions_proposed, -1.0, 1.0)
+
+				delta = tf.reduce_max(tf.abs(actions_next - actions))
+				actions = actions_next
+				if delta < tolerance:
+					break
+
+			# shrink the step when the proposals leave [-1, 1], grow it otherwise
+			step_factor = tf.clip_by_value((1.0 / tf.maximum(action_max, 1e-6))*0.1 + 0.9, 0.5,
+				2.0)
+			self.action_predict_step_size.assign(step_factor*step_size)
+			return actions
+
+		self.search_worst_actions = search_worst_actions
+
+	"""
+	ret: (n, 15) adversarial actions for the (n, state_size) states
+	"""
+	def predict_worst_actions(self, states, n_iterations=None, tolerance=0.0):
+		if self.search_worst_actions is None:
+			self.define_action_search_function()
+		if n_iterations is None:
+			n_iterations = self.action_search_iterations
+
+		return self.search_worst_actions(tf.convert_to_tensor(states, dtype=tf.float32),
+			tf.convert_to_tensor(n_iterations, dtype=tf.int32),
+			tf.convert_to_tensor(tolerance, dtype=tf.float32)).numpy()
+
 	def predict_worst_action(self):
-		action = tf.expand_dims(tf.random.normal([15], mean=0.0, stddev=0.01), 0)
-
-		for i in range(10):
-			with tf.GradientTape() as g:
-				g.watch(action)
-				reward = self.model_reward([self.state, action], training=False)
-			action_grad = g.gradient(reward, action)
-			action_grad /= tf.math.reduce_std(action_grad) + 1e-8
-			action = action - action_grad*self.action_predict_step_size
-		
-		action_max = tf.math.reduce_max(tf.abs(action))
-		self.action_predict_step_size = ((1.0 / action_max)*0.1 + 0.9)*self.action_predict_step_size
+		return convert_action_to_mixed(self.predict_worst_actions(self.state)[0])
+
+
+	def define_encoding_functions(self):
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(None, 240, 320, 4), dtype=tf.float32)
+		])
+		def encode_chunk(images):
+			return self.model_image_encoder(images, training=False)
+
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(None, None, self.image_enc_size), dtype=tf.float32),
+			tf.TensorSpec(shape=(None, None), dtype=tf.float32),
+			tf.TensorSpec(shape=(None, self.state_size), dtype=tf.float32)
+		], jit_compile=False)
+		def unroll_states(image_encs, masks, state_init):
+			def step(state, inputs):
+				image_enc, mask = inputs
+				state_new = self.model_state([state, image_enc], training=False)
+				# freeze the state of episodes that have already ended
+				return tf.where(mask[:,None] > 0.0, state_new, state)
+			return tf.scan(step, (image_encs, masks), initializer=state_init)
+
+		self.encode_chunk = encode_chunk
+		self.unroll_states_function = unroll_states
+
+	"""
+	Encode a block of frames, encode_chunk_size frames (time steps x episodes) per encoder call
+
+	The encoder is not recurrent, so the frames of all time steps can be batched together.
+	images: (T, N, 240, 320, 4), uint8 frames (e.g. memory.images) or float frames in [0, 1]
+	ret: (T, N, image_enc_size) float32 tensor
+	"""
+	def encode_images(self, images, chunk_size=None):
+		if self.encode_chunk is None:
+			self.define_encoding_functions()
+		if chunk_size is None:
+			chunk_size = self.encode_chunk_size
+
+		n_steps, n_episodes = images.shape[0], images.shape[1]
+		n_frames = n_steps*n_episodes
+		is_uint8 = images.dtype == np.uint8
+		if isinstance(images, np.ndarray):
+			images = images.reshape((n_frames,) + images.shape[2:])
+		else:
+			images = tf.reshape(images, (n_frames,) + tuple(images.shape[2:]))
+
+		image_encs = []
+		for begin in range(0, n_frames, chunk_size):
+			chunk = images[begin:begin+chunk_size]
+			# uint8 frames are only converted one chunk at a time
+			if is_uint8:
+				chunk = tf.convert_to_tensor(chunk, dtype=tf.float32) * 0.0039215686274509803
+			image_encs.append(self.encode_chunk(chunk))
+		if len(image_encs) == 0:
+			return tf.zeros((n_steps, n_episodes, self.image_enc_size))
+
+		return tf.reshape(tf.concat(image_encs, axis=0),
+			(n_steps, n_episodes, self.image_enc_size))
+
+	"""
+	Run the state model over a sequence of encodings, states of masked steps are kept as is
+
+	ret: (T, N, state_size) states after every time step
+	"""
+	def unroll_states(self, image_encs, masks, state_init=None):
+		if self.unroll_states_function is None:
+			self.define_encoding_functions()
+		if state_init is None:
+			state_init = tf.zeros((image_encs.shape[1], self.state_size))
 
-		return convert_action_to_mixed(action[0])
+		return self.unroll_states_function(tf.convert_to_tensor(image_encs, dtype=tf.float32),
+			tf.convert_to_tensor(masks, dtype=tf.float32),
+			tf.convert_to_tensor(state_init, dtype=tf.float32))
 
 
+	"""
+	The training phases of an epoch on a replay sample, one training step per entry of
+	window_starts. The progress reporter holds the mean losses of a phase afterwards.
+	"""
+	def train_encoder_phase(self, e, images, actions, rewards, state_init, masks):
+		starts = self.window_starts(self.tbptt_length_encoder, self.window_stride_encoder)
+		state_prev = state_init
+		self.reporter.reset("Epoch {:3d} - Training image encoder model".format(e),
+			total=len(starts))
+		for n, i in enumerate(starts):
+			state_prev, loss_total_tf, loss_inverse_tf =\
+				self.train_image_encoder_model(images, actions, rewards, state_prev, masks,
+				tf.convert_to_tensor(i))
+			self.apply_accumulated(self.accumulator_inverse, n, len(starts))
+			self.reporter.update(l_t=loss_total_tf, l_i=loss_inverse_tf)
+		self.reporter.close()
+
+	# ret: mean cumulative discount of the backbone windows, the prediction confidence
+	def train_backbone_phase(self, e, image_encs, actions, rewards, state_init, masks):
+		starts = self.window_starts(self.tbptt_length_backbone, self.window_stride_backbone)
+		state_prev = state_init
+		discount_cum = 0.0 # discount_cum signifies successful prediction falloff volume - "confidence"
+		self.reporter.reset("Epoch {:3d} - Training the backbone".format(e), total=len(starts))
+		for n, i in enumerate(starts):
+			state_prev, loss_total_tf, loss_reward_tf, loss_encoding_tf, discount_cum_tf =\
+				self.train_backbone(image_encs, actions, rewards, state_prev, masks,
+				tf.convert_to_tensor(i))
+			self.apply_accumulated(self.accumulator_backbone, n, len(starts))
+			discount_cum += discount_cum_tf
+			self.reporter.update(l_t=loss_total_tf, l_r=loss_reward_tf, l_e=loss_encoding_tf,
+				d_c=discount_cum_tf)
+		self.reporter.close()
+		return float(discount_cum)/len(starts)
+
+	def train_action_phase(self, e, j, image_encs, actions, rewards, state_init, masks,
+		discount_factor):
+		starts = self.window_starts(0, self.window_stride_action)
+		state_prev = state_init
+		self.reporter.reset("Epoch {:3d} - Training action model {}".format(e, j),
+			total=len(starts))
+		for i in starts:
+			state_prev, loss_total_tf, loss_reward_tf, loss_reg_tf =\
+				self.models_action[j].train(image_encs, actions, rewards, state_prev, masks,
+				tf.convert_to_tensor(i), tf.convert_to_tensor(discount_factor))
+			self.reporter.update(l_t=loss_total_tf, l_rw=loss_reward_tf, l_rg=loss_reg_tf)
+		self.reporter.close()
+
+	"""
+	memory: Memory with frames, or with image encodings (latent mode), in which case the image
+	encoder phase (which trains the inverse model) is skipped
+	"""
 	def train(self, memory):
-		n_sequences = memory.images.shape[1]
+		n_sequences = memory.n_episodes
+		if n_sequences != self.batch_size:
+			raise ValueError("Memory holds {} episodes but the model trains on batches of {}".format(
+				n_sequences, self.batch_size))
+		self.select_training_functions()
 
 		image_encs = tf.Variable(tf.zeros((self.replay_sample_length, n_sequences,
 			self.image_enc_size)))
 
 		for e in range(self.n_training_epochs):
 			# compute initial states
-			memory.compute_states(self.model_state, self.model_image_encoder)
+			memory.compute_states(self.encode_images, self.unroll_states)
+			# deferred curiosity is refreshed with the current encoding model
+			if memory.mix_reward is not None:
+				memory.set_curiosity(self.compute_curiosity(memory))
 			
-			images, actions, rewards, state_init = memory.get_sample(self.replay_sample_length)
-
-			# train the image encodet model (and reward model, 1st phase)
-			state_prev = state_init
-			loss_total = 0.0
-			loss_inverse = 0.0
-			for i in range(self.replay_sample_length-self.tbptt_length_encoder):
-				state_prev, loss_total_tf, loss_inverse_tf =\
-					self.train_image_encoder_model(images, actions, rewards,
-					state_prev, tf.convert_to_tensor(i))
-				loss_total += loss_total_tf.numpy()
-				loss_inverse += loss_inverse_tf.numpy()
-				print("Epoch {:3d} - Training image encoder model ({}/{}) l_t: {:8.5f} l_i: {:8.5f}".format(
-					e, i+self.tbptt_length_encoder+1, self.replay_sample_length,
-					loss_total/(i+1), loss_inverse/(i+1)),
-					end="\r")
-			print("")
-
-			for i in range(self.replay_sample_length):
-				image_encs[i].assign(self.model_image_encoder(images[i], training=False))
-				print("Computing image encodings... {} / {}      ".format(i+1,
-				self.replay_sample_length), end="\r")
+			images, actions, rewards, state_init, masks = memory.get_sample(self.replay_sample_length)
+
+			if memory.latent is not None:
+				# the sample already holds the encodings
+				image_encs.assign(images)
+			else:
+				# train the image encodet model (and reward model, 1st phase)
+				self.train_encoder_phase(e, images, actions, rewards, state_init, masks)
+				image_encs.assign(self.encode_images(images))
 
 			# train the backbone (image encoding, state and reward models)
-			state_prev = state_init
-			loss_total = 0.0
-			loss_reward = 0.0
-			loss_encoding = 0.0
-			discount_cum = 0.0 # discount_cum signifies successful prediction falloff volume - "confidence"
-			for i in range(self.replay_sample_length-self.tbptt_length_backbone):
-				state_prev, loss_total_tf, loss_reward_tf, loss_encoding_tf, discount_cum_tf =\
-					self.train_backbone(image_encs, actions, rewards, state_prev,
-					tf.convert_to_tensor(i))
-				loss_total += loss_total_tf.numpy()
-				loss_reward += loss_reward_tf.numpy()
-				loss_encoding += loss_encoding_tf.numpy()
-				discount_cum += discount_cum_tf.numpy()
-				print("Epoch {:3d} - Training the backbone ({}/{}) l_t: {:8.5f} l_r: {:8.5f} l_e: {:8.5f} d_c: {:8.5f}".format(
-					e, i+self.tbptt_length_backbone+1, self.replay_sample_length,
-					loss_total/(i+1), loss_reward/(i+1), loss_encoding/(i+1), discount_cum/(i+1)), end="\r")
-			print("")
+			discount_mean = self.train_backbone_phase(e, image_encs, actions, rewards, state_init,
+				masks)
 			
 			# train the action (policy) models
-			train_discount_factor = np.math.exp(-1.0/(discount_cum/(i+1))) # use prediction confidence as a basis for dc. factor
+			train_discount_factor = np.math.exp(-1.0/discount_mean) # use prediction confidence as a basis for dc. factor
 			for j in range(self.n_replay_episodes):
-				state_prev = state_init
-				loss_total = 0.0
-				loss_reward = 0.0
-				loss_reg = 0.0
-				for i in range(self.replay_sample_length):
-					state_prev, loss_total_tf, loss_reward_tf, loss_reg_tf =\
-						self.models_action[j].train(image_encs, actions, rewards, state_prev,
-						tf.convert_to_tensor(i), tf.convert_to_tensor(train_discount_factor))
-					loss_total += loss_total_tf.numpy()
-					loss_reward += loss_reward_tf.numpy()
-					loss_reg += loss_reg_tf.numpy()
-					print("Epoch {:3d} - Training action model {} ({}/{}) l_t: {:8.5f} l_rw: {:8.5f} l_rg: {:8.5f}".format(
-						e, j, i+1, self.replay_sample_length,
-						loss_total/(i+1), loss_reward/(i+1), loss_reg/(i+1)), end="\r")
-				print("")
+				self.train_action_phase(e, j, image_encs, actions, rewards, state_init, masks,
+					train_discount_factor)
 			
-			self.save_model("model/model")
-
-			del images, actions, rewards, state_init
+			# the weights are identical on all workers, only the chief saves them. Reading the
+			# batch norm statistics outside of the replica is an all-reduce, so with a strategy
+			# every worker takes the snapshot.
+			if self.checkpoint_writer is not None or self.strategy is not None:
+				checkpoint_state = self.get_checkpoint_state()
+				if self.is_chief and self.checkpoint_writer is not None:
+					if self.checkpoint_extra_state is not None:
+						checkpoint_state.update(self.checkpoint_extra_state())
+					self.checkpoint_writer.save(checkpoint_state)
+			else:
+				self.save_model("model/model")
+
+			del images, actions, rewards, state_init, masks
 			gc.collect()
 	
-	#@tf.function
-	def train_image_autoencoder(self, image):
-		n_epochs = 8
-
-		n_entries = image.shape[0]
-
-		image = tf.convert_to_tensor(image)
-		for e in range(n_epochs):
-			loss_sum = 0.0
-			for i in range(int(n_entries)):
-				with tf.GradientTape(persistent=True) as gt:
-					image_enc = self.model_image_encoder(image[i])
-					image_pred = self.model_image_decoder(image_enc)
-					loss = self.loss_image(image[i], image_pred)
-					loss_sum += loss.numpy()
-				
-				g_model_image_encoder = gt.gradient(loss, self.model_image_encoder.trainable_variables)
-				g_model_image_decoder = gt.gradient(loss, self.model_image_decoder.trainable_variables)
-				
-				print("{:2d} {:4d}/{:4d} ({})".format(e, i, n_entries, loss_sum/(i+1)), end="\r")
-			
-				self.optimizer.apply_gradients(zip(g_model_image_encoder,
-					self.model_image_encoder.trainable_variables))
-				self.optimizer.apply_gradients(zip(g_model_image_decoder,
-					self.model_image_decoder.trainable_variables))
-			
-				if i % 4 == 0:
-					img = cv2.hconcat([image[i,e].numpy(), image_pred[e].numpy()])
-					cv2.imshow("target / prediction", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-					cv2.waitKey(10)
+	"""
+	Compiled autoencoder training step on a batch of (batch, 240, 320, 4) uint8 frames
 
+	ret: (loss, reconstruction of the first frame of the batch for previews)
+	"""
+	def define_autoencoder_function(self):
+		# build the lazy decoder eagerly, not while tracing the training function
+		self.model_image_decoder
+		variables = self.model_image_encoder.trainable_variables +\
+			self.model_image_decoder.trainable_variables
+
+		@self.compile_function(input_signature=[
+			tf.TensorSpec(shape=(None, 240, 320, 4), dtype=tf.uint8)
+		])
+		def train_autoencoder_step(images):
+			images = tf.cast(images, tf.float32) * 0.0039215686274509803 # 1/255
+			with tf.GradientTape() as gt:
+				image_enc = self.model_image_encoder(images, training=True)
+				images_pred = self.model_image_decoder(image_enc, training=True)
+				loss = self.loss_image(images, images_pred)
+			gradients = gt.gradient(loss, variables)
+			self.optimizer.apply_gradients(zip(gradients, variables))
+			return loss, images_pred[0]
+
+		self.train_autoencoder_step = train_autoencoder_step
+
+	"""
+	Pretrain the image encoder together with the image decoder as an autoencoder
+
+	frames: iterable of (batch, 240, 320, 4) uint8 frame batches, e.g. EpisodeDataset.frames
+	n_steps: number of batches to train on, None for all of frames
+	preview: optional callable(step, target, prediction) that gets the first frame of every
+	preview_every'th batch and its reconstruction (tensors, not synchronized), e.g. to write
+	them to disk on another thread
+	The progress line counts frames, so its rate is the frame throughput.
+	"""
+	def train_image_autoencoder(self, frames, n_steps=None, preview=None, preview_every=500):
+		if self.train_autoencoder_step is None:
+			self.define_autoencoder_function()
+
+		self.reporter.reset("Pretraining the image encoder (frames)")
+		# islice does not take a batch more than needed from an iterator
+		for step, images in enumerate(itertools.islice(frames, n_steps)):
+			loss_tf, image_pred = self.train_autoencoder_step(images)
+			n_frames = int(images.shape[0])
+			# the reporter averages over frames, so the loss is weighted by the batch size
+			self.reporter.update(n=n_frames, l=loss_tf*n_frames)
+			if preview is not None and step % preview_every == 0:
+				preview(step, images[0], image_pred)
+		self.reporter.close()
+
+
+	"""
+	ret: dict of name -> keras model, the lazily built models only once they exist
+	"""
+	def get_keras_models(self):
+		models = {
+			"image_encoder": self.model_image_encoder,
+			"state": self.model_state,
+			"reward": self.model_reward,
+			"encoding": self.model_encoding,
+		}
+		if self._model_image_decoder is not None:
+			models["image_decoder"] = self._model_image_decoder
+		if self._model_inverse is not None:
+			models["inverse"] = self._model_inverse
+		for i in range(self.n_replay_episodes):
+			models["action_{}".format(i)] = self.models_action[i].model_action
+		return models
+
+	def get_optimizers(self):
+		return {"optimizer": self.optimizer, "action_optimizer": self.action_optimizer}
+
+	"""
+	Snapshot weights and optimizer state into a flat dict of numpy arrays
+
+	The copy is taken on the calling (training) thread, writing it to disk can then happen
+	in the background. The optimizer slots are keyed by the model and the index of the
+	variable they belong to, like the weights.
+	"""
+	def get_checkpoint_state(self):
+		state = {}
+		models = self.get_keras_models()
+		for name, model in models.items():
+			for i, w in enumerate(model.get_weights()):
+				state["model/{}/{}".format(name, i)] = w
+
+		for opt_name, opt in self.get_optimizers().items():
+			state["optimizer/{}/iterations".format(opt_name)] = opt.iterations.numpy()
+			for name, model in models.items():
+				for i, var in enumerate(model.trainable_variables):
+					for slot_name in opt.get_slot_names():
+						try:
+							slot = opt.get_slot(var, slot_name)
+						except KeyError: # variable not trained by this optimizer (yet)
+							continue
+						state["optimizer/{}/{}/{}/{}".format(opt_name, name, i, slot_name)] =\
+							slot.numpy()
+		return state
+
+	def set_checkpoint_state(self, state):
+		# build the lazy models that are part of the checkpoint
+		if "model/image_decoder/0" in state:
+			self.model_image_decoder
+		if "model/inverse/0" in state:
+			self.model_inverse
+
+		models = self.get_keras_models()
+		for name, model in models.items():
+			n_weights = len(model.weights)
+			model.set_weights([state["model/{}/{}".format(name, i)] for i in range(n_weights)])
+
+		if any(key.startswith("optimizers/") for key in state):
+			print("The optimizer state of this checkpoint format is not restored")
+
+		for opt_name, opt in self.get_optimizers().items():
+			prefix = "optimizer/{}/".format(opt_name)
+			if prefix + "iterations" not in state:
+				continue
+			# add_slot creates the slots of variables that were not trained yet in this process,
+			# the optimizer uses them once it gets to these variables
+			with self.strategy_scope():
+				for key, value in state.items():
+					if key.startswith(prefix) and key != prefix + "iterations":
+						name, i, slot_name = key[len(prefix):].split("/")
+						opt.add_slot(models[name].trainable_variables[int(i)], slot_name).assign(
+							value)
+			opt.iterations.assign(state[prefix + "iterations"])
 
 	def save_model(self, filename_prefix):
 		print("Saving model with prefix: {}".format(filename_prefix))
 		self.model_image_encoder.save_weights("{}_image_encoder.h5".format(filename_prefix))
-		self.model_image_decoder.save_weights("{}_image_decoder.h5".format(filename_prefix))
+		if self._model_image_decoder is not None:
+			self.model_image_decoder.save_weights("{}_image_decoder.h5".format(filename_prefix))
 		self.model_state.save_weights("{}_state.h5".format(filename_prefix))
 		for i in range(self.n_replay_episodes):
 			self.models_action[i].save("{}_action_{}.h5".format(filename_prefix, i))
 		self.model_reward.save_weights("{}_reward.h5".format(filename_prefix))
 		self.model_encoding.save_weights("{}_encoding.h5".format(filename_prefix))
-		self.model_inverse.save_weights("{}_inverse.h5".format(filename_prefix))
+		if self._model_inverse is not None:
+			self.model_inverse.save_weights("{}_inverse.h5".format(filename_prefix))
 	
 	def load_model(self, filename_prefix):
 		print("Loading model with prefix: {}".format(filename_prefix))
 		self.model_image_encoder.load_weights("{}_image_encoder.h5".format(filename_prefix))
-		self.model_image_decoder.load_weights("{}_image_decoder.h5".format(filename_prefix))
+		# the lazily built models are only saved when they existed
+		if os.path.exists("{}_image_decoder.h5".format(filename_prefix)):
+			self.model_image_decoder.load_weights("{}_image_decoder.h5".format(filename_prefix))
 		self.model_state.load_weights("{}_state.h5".format(filename_prefix))
 		for i in range(self.n_replay_episodes):
 			self.models_action[i].load("{}_action_{}.h5".format(filename_prefix, i))
 		self.model_reward.load_weights("{}_reward.h5".format(filename_prefix))
 		self.model_encoding.load_weights("{}_encoding.h5".format(filename_prefix))
-		self.model_inverse.load_weights("{}_inverse.h5".format(filename_prefix))
+		if os.path.exists("{}_inverse.h5".format(filename_prefix)):
+			self.model_inverse.load_weights("{}_inverse.h5".format(filename_prefix))
 
 		#self.create_recurrent_module()
\ No newline at end of file
@@ -0,0 +1,106 @@
+import numpy as np
+import tensorflow as tf
+
+
+class Planner:
+    """
+    Model-predictive action selection using the learned world model
+
+    K candidate action sequences of length horizon are rolled out through model_encoding,
+    model_state and model_reward in one vectorized graph, the same way ActionModel.train
+    imagines the future. method="cem" refits the sampling distribution to the best (elite)
+    sequences for n_iterations rounds and acts on its mean, method="shooting" samples once and
+    acts on the best sequence.
+    """
+    def __init__(self, model, horizon=8, n_candidates=256, method="cem", n_iterations=3,
+        n_elites=32, discount_factor=0.98, action_std=0.5):
+        if method not in ("cem", "shooting"):
+            raise ValueError("Unknown planning method: {}".format(method))
+
+        self.model = model
+        self.horizon = horizon
+        self.n_candidates = n_candidates
+        self.method = method
+        self.n_iterations = n_iterations if method == "cem" else 1
+        self.n_elites = min(n_elites, n_candidates)
+        self.discount_factor = discount_factor
+        self.action_std = action_std
+
+        # compiled planning functions per configuration, the rollout length is unrolled
+        # into the graph so every (horizon, n_candidates, ...) needs its own trace
+        self.plan_functions = {}
+
+        self.reset()
+
+    # forget the warm start (after an episode)
+    def reset(self):
+        self.action_mean = np.zeros((self.horizon, 15), dtype=np.float32)
+
+    def get_plan_function(self):
+        key = (self.horizon, self.n_candidates, self.n_iterations, self.n_elites,
+            self.discount_factor)
+        if key not in self.plan_functions:
+            self.plan_functions[key] = self.define_plan_function(*key)
+        return self.plan_functions[key]
+
+    def define_plan_function(self, horizon, n_candidates, n_iterations, n_elites,
+        discount_factor):
+        model = self.model
+        discounts = tf.constant(discount_factor**np.arange(horizon), dtype=tf.float32)
+
+        """
+        ret: (n_candidates,) discounted predicted return of each action sequence
+        """
+        def rollout(image_enc, state, actions):
+            image_enc = tf.tile(image_enc, [n_candidates, 1])
+            state = tf.tile(state, [n_candidates, 1])
+
+            returns = tf.zeros((n_candidates,))
+            for t in range(horizon):
+                if t > 0:
+                    image_enc = model.model_encoding([image_enc, state, actions[:, t-1]],
+                        training=False)
+                    state = model.model_state([state, image_enc], training=False)
+                reward = model.model_reward([state, actions[:, t]], training=False)
+                returns += reward[:, 0]*discounts[t]
+            return returns
+
+        @model.compile_function(input_signature=[
+            tf.TensorSpec(shape=(1, model.image_enc_size), dtype=tf.float32),
+            tf.TensorSpec(shape=(1, model.state_size), dtype=tf.float32),
+            tf.TensorSpec(shape=(horizon, 15), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.float32)
+        ], jit_compile=False)
+        def plan(image_enc, state, action_mean, action_std):
+            action_std = tf.fill(tf.shape(action_mean), action_std)
+            for i in range(n_iterations):
+                actions = tf.clip_by_value(action_mean[None] +
+                    action_std[None]*tf.random.normal((n_candidates, horizon, 15)), -1.0, 1.0)
+                returns = rollout(image_enc, state, actions)
+
+                returns_elite, elite_ids = tf.math.top_k(returns, n_elites)
+                actions_elite = tf.gather(actions, elite_ids)
+                action_mean = tf.reduce_mean(actions_elite, axis=0)
+                action_std = tf.math.reduce_std(actions_elite, axis=0) + 1e-3
+
+            return action_mean, actions_elite[0], returns_elite[0]
+
+        return plan
+
+    """
+    Plan from the current model state (after Model.advance)
+
+    ret: action (15,) to perform next
+    """
+    def __call__(self):
+        action_mean, action_best, return_best = self.get_plan_function()(
+            self.model.image_enc, self.model.state,
+            tf.convert_to_tensor(self.action_mean), tf.constant(self.action_std))
+
+        plan = action_mean.numpy() if self.method == "cem" else action_best.numpy()
+
+        # warm start the next step with the rest of the plan
+        self.action_mean[:-1] = plan[1:]
+        self.action_mean[-1] = 0.0
+
+        return plan[0]
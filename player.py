@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Lightweight player for a bundle written by export.py. Only needs
+# TensorFlow (or just the TFLite interpreter) and ViZDoom, the training
+# graph is never built.
+#
+#   python3 player.py model/export             # SavedModel
+#   python3 player.py model/export/policy.tflite
+#####################################################################
+
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from utils import get_null_action
+
+
+class Player:
+    def __init__(self, path):
+        if path.endswith(".tflite"):
+            self.interpreter = tf.lite.Interpreter(model_path=path)
+            self.step = self.interpreter.get_signature_runner("serving_default")
+        else:
+            # the signature only holds weak references to the variables of the loaded module
+            self.module = tf.saved_model.load(path)
+            self.step = self.module.signatures["serving_default"]
+
+        self.image_enc_size = self.step_output_size("image_enc")
+        self.state_size = self.step_output_size("state")
+        self.reset()
+
+    def step_output_size(self, name):
+        if hasattr(self, "interpreter"):
+            return int(self.step.get_output_details()[name]["shape"][-1])
+        return int(self.step.structured_outputs[name].shape[-1])
+
+    # reset the recurrent state (after an episode)
+    def reset(self):
+        self.image_enc = np.zeros((1, self.image_enc_size), dtype=np.float32)
+        self.state = np.zeros((1, self.state_size), dtype=np.float32)
+        self.action_prev = get_null_action().astype(np.float32)
+        self.curiosity = 0.0
+
+    """
+    image: (240, 320, 4) uint8 screen buffer with the automap as the 4th channel
+    ret: action (15,) in the continuous domain
+    """
+    def act(self, image):
+        outputs = self.step(
+            image=np.asarray(image, dtype=np.uint8)[None],
+            action_prev=self.action_prev[None],
+            image_enc=self.image_enc,
+            state=self.state)
+
+        self.image_enc = np.asarray(outputs["image_enc"])
+        self.state = np.asarray(outputs["state"])
+        self.curiosity = float(np.asarray(outputs["curiosity"])[0])
+        self.action_prev = np.asarray(outputs["action"])[0]
+        return self.action_prev
+
+
+def main():
+    from init_game import init_game
+    from utils import convert_action_to_mixed
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bundle', type=str, help="export directory or .tflite file")
+    parser.add_argument('--episodes', type=int, default=1)
+    parser.add_argument('--episode_length', type=int, default=4096)
+    parser.add_argument('--wad', type=str, default=None, help="scenario wad, e.g. an oblige map")
+    parser.add_argument('--map', type=str, default="map01")
+    parser.add_argument('--window_visible', action='store_true')
+    args = parser.parse_args()
+
+    player = Player(args.bundle)
+    game = init_game(args.episode_length, args.window_visible)
+    if args.wad is not None:
+        game.close()
+        game.set_doom_scenario_path(args.wad)
+        game.init()
+    game.set_doom_map(args.map)
+
+    for i in range(args.episodes):
+        game.new_episode()
+        game.send_game_command('am_scale 0.5')
+        player.reset()
+
+        n_steps = 0
+        while not game.is_episode_finished():
+            state_game = game.get_state()
+            image = np.concatenate([state_game.screen_buffer,
+                state_game.automap_buffer[:,:,0:1]], axis=-1)
+            game.make_action(convert_action_to_mixed(player.act(image)))
+            n_steps += 1
+
+        print("Episode {} finished after {} steps, total reward: {:10.3f}".format(
+            i, n_steps, game.get_total_reward()))
+
+    game.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+#####################################################################
+# Offline pretraining of the image encoder as an autoencoder on the
+# frames of an episode dataset (see dataset.py). Runs headless, the
+# reconstructions can be dumped to disk as PNG previews.
+#
+#   python3 pretrain.py --dataset_dir data/episodes --steps 20000 \
+#       --preview_dir eval/autoencoder
+#####################################################################
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class PreviewWriter:
+    """
+    Writes target / reconstruction pairs as PNG files on a background thread
+
+    Every preview shows the target on the left and the reconstruction on the right, the screen
+    on top and the automap below.
+    """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def __call__(self, step, target, prediction):
+        self.futures.append(self.executor.submit(self.write, step, target, prediction))
+
+    def write(self, step, target, prediction):
+        import tensorflow as tf
+
+        target = np.asarray(target)
+        prediction = np.round(np.clip(np.asarray(prediction), 0.0, 1.0)*255.0).astype(np.uint8)
+        image = np.concatenate([target, prediction], axis=1)
+        image = np.concatenate([image[:,:,0:3], np.repeat(image[:,:,3:4], 3, axis=2)], axis=0)
+        tf.io.write_file(os.path.join(self.directory, "preview_{:08d}.png".format(step)),
+            tf.io.encode_png(image))
+
+    # wait for the pending previews, raises if writing one of them failed
+    def close(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, default="data/episodes")
+    parser.add_argument('--checkpoint_dir', type=str, default="model/checkpoints")
+    parser.add_argument('--keep_checkpoints', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20000, help="batches to train on")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--shuffle_buffer', type=int, default=4096,
+        help="frames to shuffle over, each takes 300 KB")
+    parser.add_argument('--checkpoint_every', type=int, default=5000)
+    parser.add_argument('--preview_dir', type=str, default=None,
+        help="write target / reconstruction previews as PNG files to this directory")
+    parser.add_argument('--preview_every', type=int, default=500)
+    parser.add_argument('--xla', action='store_true', help="XLA compile the training step")
+    args = parser.parse_args()
+
+    from checkpoint import CheckpointWriter, load_latest_checkpoint
+    from dataset import EpisodeDataset
+    from model import Model
+
+    dataset = EpisodeDataset(args.dataset_dir)
+    print("Pretraining on {} episodes from {}".format(dataset.n_episodes(), args.dataset_dir))
+
+    model = Model(dataset.episode_length, 8, 1, 256, jit_compile=args.xla)
+    checkpoint = load_latest_checkpoint(args.checkpoint_dir)
+    if checkpoint is not None:
+        model.set_checkpoint_state(checkpoint[1])
+    model.checkpoint_writer = CheckpointWriter(args.checkpoint_dir, keep=args.keep_checkpoints)
+    preview = PreviewWriter(args.preview_dir) if args.preview_dir is not None else None
+
+    # the dataset repeats, every segment continues where the last one stopped
+    frames = iter(dataset.frames(args.batch_size, shuffle_buffer=args.shuffle_buffer))
+    for begin in range(0, args.steps, args.checkpoint_every):
+        preview_segment = None
+        if preview is not None:
+            preview_segment = lambda step, target, prediction: preview(begin+step, target,
+                prediction)
+        model.train_image_autoencoder(frames, n_steps=min(args.checkpoint_every, args.steps-begin),
+            preview=preview_segment, preview_every=args.preview_every)
+        model.checkpoint_writer.save(model.get_checkpoint_state())
+
+    if preview is not None:
+        preview.close()
+    model.checkpoint_writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import sys
+import time
+
+
+class ProgressReporter:
+    """
+    Rate-limited progress line for the hot loops
+
+    update() only accumulates counts and sums (python floats or tensors, which are not
+    synchronized until they are printed). The line is formatted and written at most rate_hz
+    times per second and shows the iteration rate since the last refresh and the mean of
+    every value since reset. rate_hz=0 disables the output.
+    """
+    def __init__(self, label="", rate_hz=4.0, stream=None):
+        self.interval = 1.0/rate_hz if rate_hz > 0 else float("inf")
+        self.stream = stream if stream is not None else sys.stdout
+        self.line_open = False
+        self.reset(label)
+
+    def reset(self, label=None, total=None):
+        if label is not None:
+            self.label = label
+        self.total = total
+        self.n = 0
+        self.sums = {}
+        self.rate = 0.0
+        self.t_report = time.perf_counter()
+        self.n_report = 0
+
+    def update(self, n=1, **values):
+        self.n += n
+        for name, value in values.items():
+            self.sums[name] = self.sums.get(name, 0.0) + value
+
+        t = time.perf_counter()
+        if t - self.t_report >= self.interval:
+            self.rate = (self.n - self.n_report) / (t - self.t_report)
+            self.t_report = t
+            self.n_report = self.n
+            self.report()
+
+    def mean(self, name):
+        return float(self.sums[name]) / max(self.n, 1)
+
+    def report(self):
+        progress = "{}/{}".format(self.n, self.total) if self.total is not None else str(self.n)
+        values = " ".join("{}: {:8.5f}".format(name, self.mean(name)) for name in self.sums)
+        self.stream.write("\r{} ({}) {:8.1f} it/s {}".format(self.label, progress, self.rate,
+            values))
+        self.stream.flush()
+        self.line_open = True
+
+    # print a line of its own, below the progress line
+    def message(self, text):
+        if self.line_open:
+            self.stream.write("\n")
+            self.line_open = False
+        self.stream.write(text + "\n")
+        self.stream.flush()
+
+    # final refresh of the progress line
+    def close(self):
+        if self.interval != float("inf"):
+            self.report()
+            self.stream.write("\n")
+            self.stream.flush()
+        self.line_open = False
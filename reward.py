@@ -212,33 +212,36 @@ class Reward():
     def get_misc_reward(self, game):
         return game.get_game_variable(vzd.ATTACK_READY) - 1.0
 
-    def get_reward(self, game, action):
-        player_pos = get_player_pos(game)
-
-        living_reward = 0.0
-
-        velocity_reward = self.get_velocity_reward(game)
-
+    # weights of the reward components in get_reward
+    reward_weights = {
+        "living": 1.0,
+        "velocity": 1.0,
+        "item": 0.5,
+        "combat": 2.0,
+        "action": 1.0,
+        "misc": 1.0,
+    }
+
+    """
+    ret: dict of the unweighted reward components of the current step
+    """
+    def get_reward_components(self, game, action):
         #start_dist_reward = 0.0#self.get_start_distance_reward(player_pos)
 
         #exploration_reward = 0.0#self.get_exploration_reward(player_pos)
 
-        item_reward = self.get_item_reward(game)
+        return {
+            "living": 0.0,
+            "velocity": self.get_velocity_reward(game),
+            "item": self.get_item_reward(game),
+            "combat": self.get_combat_reward(game),
+            "action": self.get_action_reward(action),
+            "misc": self.get_misc_reward(game),
+        }
 
-        combat_reward = self.get_combat_reward(game)
-        
-        action_reward = self.get_action_reward(action)
-
-        misc_reward = self.get_misc_reward(game)
-        #print(misc_reward)
-
-        return\
-            living_reward +\
-            1.0*velocity_reward +\
-            0.5*item_reward +\
-            2.0*combat_reward +\
-            1.0*action_reward +\
-            1.0*misc_reward
+    def get_reward(self, game, action):
+        components = self.get_reward_components(game, action)
+        return sum(self.reward_weights[name]*value for name, value in components.items())
     
     def get_distance(self, game):
         return np.linalg.norm(get_player_pos(game) - self.player_start_pos)
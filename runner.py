@@ -4,10 +4,10 @@ import time
 
 def main():
     os.system("export PYTHONFAULTHANDLER=1")
-    ret = os.system("python3 main.py")
+    ret = os.system("python3 main.py --memory_dir model/replay")
     while ret != 0:
         time.sleep(2)
-        ret = os.system("python3 main.py --model model/model")
+        ret = os.system("python3 main.py --memory_dir model/replay --resume")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
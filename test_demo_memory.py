@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+
+vzd = pytest.importorskip("vizdoom")
+pytest.importorskip("tensorflow")
+
+from demo_memory import DemoMemory
+from init_game import init_game
+from utils import convert_action_to_mixed
+
+
+EPISODE_LENGTH = 48
+
+
+# init_game loads wads/doom2.wad, freedoom2 (shipped with vizdoom) stands in for it
+@pytest.fixture
+def game_dir(tmp_path, monkeypatch):
+    doom2 = os.path.abspath(os.path.join("wads", "doom2.wad"))
+    if not os.path.exists(doom2):
+        doom2 = os.path.join(os.path.dirname(vzd.__file__), "freedoom2.wad")
+    os.makedirs(tmp_path / "wads")
+    os.symlink(doom2, tmp_path / "wads" / "doom2.wad")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+"""
+Play one episode with random actions like TrainerInterface.run, recording its demo
+ret: the frames seen while playing
+"""
+def play_episode(memory, wad_filename):
+    rng = np.random.default_rng(0)
+    game = init_game(EPISODE_LENGTH, False)
+    game.close()
+    game.set_doom_scenario_path(wad_filename)
+    game.init()
+    game.set_doom_map("map01")
+
+    demo_path = memory.begin_episode({"seed": 0, "wad": wad_filename, "map": "map01"})
+    game.new_episode(demo_path)
+    game.send_game_command('am_scale 0.5')
+
+    frames = []
+    time_step = 0
+    while not game.is_episode_finished():
+        state_game = game.get_state()
+        frame = memory.image_slot(time_step)
+        frame[:,:,0:3] = state_game.screen_buffer
+        frame[:,:,3] = state_game.automap_buffer[:,:,0]
+        frames.append(frame.copy())
+
+        action = rng.uniform(-1.0, 1.0, 15)
+        game.make_action(convert_action_to_mixed(action))
+        memory.store_entry(time_step, None, action, 0.0)
+        time_step += 1
+    memory.finish_episode()
+    game.close()
+    return np.stack(frames)
+
+
+def test_replay_renders_the_played_frames(game_dir):
+    wad_filename = str(game_dir / "wads" / "doom2.wad")
+    memory = DemoMemory(1, EPISODE_LENGTH, storage_dir=str(game_dir / "demos"), n_workers=1,
+        replay_chunk_size=16)
+    try:
+        frames = play_episode(memory, wad_filename)
+        length = len(frames)
+        assert length == memory.episode_lengths[0]
+        assert frames.any()
+
+        np.testing.assert_array_equal(memory.get_frames(0, length)[:, 0], frames)
+        # a window inside the episode replays up to its begin first
+        np.testing.assert_array_equal(memory.get_frames(8, 16)[:, 0], frames[8:24])
+    finally:
+        memory.close()
@@ -0,0 +1,105 @@
+import json
+import sys
+import types
+import numpy as np
+
+# utils only needs vizdoom for reading game variables
+sys.modules.setdefault("vizdoom", types.ModuleType("vizdoom"))
+
+from utils import ActionNoise, convert_actions_to_mixed, convert_actions_to_continuous,\
+    convert_action_to_mixed, convert_action_to_continuous
+
+
+# the single-action conversions the batched ones replaced
+def reference_action_to_mixed(action_cont):
+    action_mixed = np.where(action_cont > 0.0, True, False).tolist()
+    action_mixed[14] = action_cont[14]*10.0
+    return action_mixed
+
+
+def reference_action_to_continuous(action_mixed):
+    action_cont = np.where(action_mixed, 0.5, -0.5)
+    action_cont[14] = action_mixed[14] / 10.0
+    return action_cont
+
+
+def random_actions(rng, shape):
+    return rng.uniform(-1.0, 1.0, shape + (15,))
+
+
+def test_mixed_continuous_round_trip():
+    rng = np.random.default_rng(0)
+    actions_mixed = convert_actions_to_mixed(random_actions(rng, (64, 8)))
+    round_trip = convert_actions_to_mixed(convert_actions_to_continuous(actions_mixed))
+    np.testing.assert_array_equal(round_trip[..., 0:14], actions_mixed[..., 0:14])
+    np.testing.assert_allclose(round_trip[..., 14], actions_mixed[..., 14])
+
+
+def test_batched_conversion_matches_single_action():
+    rng = np.random.default_rng(1)
+    actions = random_actions(rng, (256,))
+    actions_mixed = convert_actions_to_mixed(actions)
+    for action, action_mixed in zip(actions, actions_mixed):
+        reference = reference_action_to_mixed(action)
+        np.testing.assert_allclose(action_mixed, np.asarray(reference, dtype=np.float64))
+        np.testing.assert_allclose(convert_action_to_mixed(action), reference)
+        np.testing.assert_allclose(convert_action_to_continuous(reference),
+            reference_action_to_continuous(reference))
+
+
+def test_conversion_into_out_array():
+    rng = np.random.default_rng(2)
+    actions = random_actions(rng, (16,))
+    out = np.empty_like(actions)
+    assert convert_actions_to_mixed(actions, out=out) is out
+    np.testing.assert_array_equal(out, convert_actions_to_mixed(actions))
+
+
+def draw_actions(noise):
+    actions = noise.random_actions(32, weapon_switch_prob=0.5)
+    return [actions, noise.mutate_actions(actions, 3, weapon_switch_prob=0.5),
+        noise.episode_actions(16, 4, weapon_switch_prob=0.5)]
+
+
+def check_action_ranges(actions):
+    actions = actions.reshape(-1, 15)
+    assert np.all(np.abs(actions) <= 0.9)
+    # at most one weapon is selected, the other slots are not pressed
+    assert np.all(np.sum(actions[:, 7:14] > 0.0, axis=-1) <= 1)
+
+
+def test_action_noise_is_deterministic():
+    for actions_a, actions_b in zip(draw_actions(ActionNoise(7)), draw_actions(ActionNoise(7))):
+        np.testing.assert_array_equal(actions_a, actions_b)
+    assert not np.array_equal(ActionNoise(7).random_actions(8), ActionNoise(8).random_actions(8))
+
+
+def test_action_noise_ranges():
+    noise = ActionNoise(3)
+    actions, actions_mutated, actions_episode = draw_actions(noise)
+    assert actions.shape == (32, 15) and actions_mutated.shape == (32, 15)
+    assert actions_episode.shape == (16, 4, 15)
+    for a in (actions, actions_mutated, actions_episode):
+        check_action_ranges(a)
+
+    # never left and right or forward and back at once
+    for a, b in ((3, 4), (5, 6)):
+        assert not np.any((actions[:, a] > 0.0) & (actions[:, b] > 0.0))
+    # with certain switching every action selects a weapon
+    assert np.all(np.sum(noise.random_actions(64, weapon_switch_prob=1.0)[:, 7:14] > 0.0,
+        axis=-1) == 1)
+    # without flips the buttons are kept
+    np.testing.assert_array_equal(noise.mutate_actions(actions, 0)[:, 0:7], actions[:, 0:7])
+
+
+def test_action_noise_state_round_trip():
+    noise = ActionNoise(11)
+    noise.random_actions(5)
+    # the trainer stores the state as json in the checkpoint
+    state = json.loads(json.dumps(noise.get_state()))
+    expected = draw_actions(noise)
+
+    noise_restored = ActionNoise()
+    noise_restored.set_state(state)
+    for actions, actions_restored in zip(expected, draw_actions(noise_restored)):
+        np.testing.assert_array_equal(actions, actions_restored)
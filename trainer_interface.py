@@ -1,22 +1,46 @@
 from reward import Reward
-from model import Model
 from memory import Memory
+from demo_memory import DemoMemory
 import numpy as np
-import tensorflow as tf
 import random
 import math
 import time
 from random import choice
 from utils import *
 from generate_maps import *
+from checkpoint import get_rng_state, set_rng_state
+from progress import ProgressReporter
 import cv2
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 class TrainerInterface:
 	def __init__(self, model, reward, n_episodes, episode_length, minimum_episode_length,
-		window_visible):
+		window_visible, memory_dir=None, seed=None, planner=None, reporter=None,
+		wad_filename="wads/temp/oblige.wad", memory_latent=None, demo_dir=None, action_latency=0,
+		defer_curiosity=False):
 		self.model = model
+		# per-step progress (fps, mean reward), rate-limited
+		self.reporter = reporter if reporter is not None else ProgressReporter("Collecting")
 		self.reward = reward
+		self.planner = planner # model-predictive action selection, see planner.py
+		self.action_noise = ActionNoise(seed) # exploration noise
+		self.memory = None
+		self.memory_dir = memory_dir # memory-mapped replay storage, None keeps it in RAM
+		self.wad_filename = wad_filename # one per worker when training distributed
+		self.memory_latent = memory_latent # store image encodings instead of frames, see Memory
+		self.demo_dir = demo_dir # record demos instead of frames, see DemoMemory
+		self.map_seed = None # oblige seed of the current maps
+		# curiosity computed in batches at training time instead of while playing
+		self.defer_curiosity = defer_curiosity
+
+		# with a latency of 1 step the engine plays the action decided on the previous frame
+		# while the model looks at the current one (both release the GIL)
+		if action_latency not in (0, 1):
+			raise ValueError("Unsupported action latency: {}".format(action_latency))
+		self.action_latency = action_latency
+		self.executor = ThreadPoolExecutor(max_workers=1) if action_latency > 0 else None
 
 		self.episode_id = 0
 		self.n_replay_episodes = n_episodes
@@ -24,7 +48,7 @@ class TrainerInterface:
 		self.minimum_episode_length = minimum_episode_length
 		self.window_visible = window_visible
 		self.episode_reset()
-		self.n_discards = 0
+		self.n_underlength = 0
 
 	"""
 	Reset after an episode
@@ -32,10 +56,15 @@ class TrainerInterface:
 	def episode_reset(self):
 		self.reward.reset()
 		self.model.reset_state()
-		self.action_prev = get_null_action()
+		if self.planner is not None:
+			self.planner.reset()
+		self.action_prev = get_null_action() # last decided action, pick_action continues from it
+		self.action_executed = get_null_action() # action played on the previous tic
+		self.action_next = get_null_action() # decided, not yet played (action_latency 1)
 
 		self.reward_cum = 0.0 # cumulative reward
 		self.n_entries = 0
+		self.reporter.reset("Episode {}".format(self.episode_id), total=self.episode_length)
 
 	"""
 	Pick an action to perform next
@@ -44,7 +73,17 @@ class TrainerInterface:
 	"""
 	def pick_action(self, game):
 		# pick an action to perform
-		return get_random_action(weapon_switch_prob=0.03)
+		if self.planner is not None:
+			return self.planner()
+		return self.action_noise.random_actions(1, weapon_switch_prob=0.03)[0]
+
+	"""
+	Greedy action from the current model state, planned if a planner is set
+	"""
+	def predict_action(self):
+		if self.planner is not None:
+			return self.planner()
+		return self.model.predict_action(self.memory.active_episode)
 
 	def pick_top_replay_entries(self):
 		return self.memory.get_best_entries(int(len(self.memory.sequence)/2))
@@ -52,10 +91,42 @@ class TrainerInterface:
 	def mix_reward(self, reward_model, reward_game, reward_system):
 		return reward_model + reward_game + reward_system
 	
+	def create_memory(self, restore=False):
+		mix_reward = self.mix_reward if self.defer_curiosity else None
+		if self.demo_dir is not None:
+			return DemoMemory(self.n_replay_episodes, self.episode_length, discount_factor=0.98,
+				storage_dir=self.demo_dir, restore=restore, mix_reward=mix_reward)
+		return Memory(self.n_replay_episodes, self.episode_length, discount_factor=0.98,
+			storage_dir=self.memory_dir, restore=restore, latent=self.memory_latent,
+			mix_reward=mix_reward)
+
+	"""
+	Continue from the replay memory of a crashed process (needs memory_dir)
+	"""
+	def restore_memory(self):
+		if self.memory_dir is not None or self.demo_dir is not None:
+			self.memory = self.create_memory(restore=True)
+
+	def get_checkpoint_state(self):
+		state = get_rng_state()
+		state["trainer/episode_id"] = np.array(self.episode_id)
+		state["trainer/n_underlength"] = np.array(self.n_underlength)
+		state["trainer/action_noise"] = np.array(json.dumps(self.action_noise.get_state()))
+		return state
+
+	def set_checkpoint_state(self, state):
+		set_rng_state(state)
+		if "trainer/episode_id" in state:
+			self.episode_id = int(state["trainer/episode_id"])
+			self.n_underlength = int(state["trainer/n_underlength"])
+		if "trainer/action_noise" in state:
+			self.action_noise.set_state(json.loads(str(state["trainer/action_noise"])))
+	
 	def generate_new_maps(self, game):
 		game.close()
-		generate_maps(seed=random.randint(0, 999999999999))
-		game.set_doom_scenario_path("wads/temp/oblige.wad")
+		self.map_seed = random.randint(0, 999999999999)
+		generate_maps(filename=self.wad_filename, seed=self.map_seed)
+		game.set_doom_scenario_path(self.wad_filename)
 		game.init()
 	
 	def run(self, game):
@@ -64,20 +135,32 @@ class TrainerInterface:
 			    "map11", "map12", "map13", "map14", "map15",
 			    "map16", "map17", "map18", "map19", "map20"]
 		
-		self.memory = Memory(self.n_replay_episodes, self.episode_length, discount_factor=0.98)
+		# a partially filled memory is left over when resuming after a crash
+		if self.memory is None or self.memory.is_full():
+			if self.memory is not None:
+				self.memory.close()
+			self.memory = self.create_memory()
 		self.generate_new_maps(game)
 
 		while True:
-			if self.n_discards >= 10: # generate new maps if some of the current ones proves too difficult
+			if self.n_underlength >= 10: # generate new maps if some of the current ones proves too difficult
 				self.generate_new_maps(game)
+				self.n_underlength = 0
 			
-			game.set_doom_map(map_names[self.episode_id%self.n_replay_episodes])
-			game.new_episode()
+			map_name = map_names[self.episode_id%self.n_replay_episodes]
+			game.set_doom_map(map_name)
+
+			self.episode_reset()
+			demo_path = self.memory.begin_episode(
+				{"seed": self.map_seed, "wad": self.wad_filename, "map": map_name})
+			if demo_path is not None:
+				game.new_episode(demo_path) # record the episode
+			else:
+				game.new_episode()
 
 			# setup automap scale
 			game.send_game_command('am_scale 0.5')
 
-			self.episode_reset()
 			self.reward.player_start_pos = get_player_pos(game)
 
 			frame_id = 0
@@ -87,24 +170,44 @@ class TrainerInterface:
 
 				frame_id += 1
 
+	"""
+	Advance the model state with the frame and pick the next action
+
+	Does not touch the game, so it can run while the engine simulates a tic.
+	ret: (curiosity reward, action)
+	"""
+	def infer(self, game, image):
+		if self.defer_curiosity:
+			self.model.advance(image, self.action_executed, curiosity=False)
+			return 0.0, self.pick_action(game)
+		reward_model = self.model.advance(image, self.action_executed).numpy()
+		return reward_model, self.pick_action(game)
+
 	def step(self, game, frame_id):
 		state_game = game.get_state()
 
-		automap = state_game.automap_buffer[:,:,0:1] # use the red channel, should be enough
-		screen_buf = np.concatenate([state_game.screen_buffer, automap], axis=-1)
+		# write the frame straight into its replay memory slot
+		screen_buf = self.memory.image_slot(self.n_entries)
+		screen_buf[:,:,0:3] = state_game.screen_buffer
+		screen_buf[:,:,3] = state_game.automap_buffer[:,:,0] # use the red channel, should be enough
 		if self.window_visible:
-			cv2.imshow("ViZDoom Automap", automap)
+			cv2.imshow("ViZDoom Automap", screen_buf[:,:,3])
 			cv2.waitKey(1)
 		
-		# advance the model state using the screen buffer
-		reward_model = self.model.advance(screen_buf, self.action_prev).numpy()
-		
-		# pick an action to perform
-		action = self.pick_action(game)
-		self.action_prev = action # store the action for next step
-
-		# Only pick up the death penalty from the builtin reward system
-		reward_game = game.make_action(convert_action_to_mixed(action))
+		if self.action_latency == 0:
+			reward_model, action = self.infer(game, screen_buf)
+			self.action_prev = action # store the action for next step
+
+			# Only pick up the death penalty from the builtin reward system
+			reward_game = game.make_action(convert_action_to_mixed(action))
+		else:
+			# play the action decided on the previous frame while deciding the next one
+			action = self.action_next
+			self.action_prev = action
+			inference = self.executor.submit(self.infer, game, screen_buf)
+			reward_game = game.make_action(convert_action_to_mixed(action))
+			reward_model, self.action_next = inference.result()
+		self.action_executed = action
 
 		# Fetch rest of the rewards from our own reward system
 		reward_system = self.reward.get_reward(game, action)
@@ -114,29 +217,31 @@ class TrainerInterface:
 		# update cumulative reward
 		self.reward_cum += reward
 
-		# TODO temp
-		action_print = np.where(action>0.0, 1, 0)
-		print("{} {:8.3f} | r: {:3.8f} e: {:2.8f}".format(
-			action_print[0:14], action[14]*10.0, reward, self.epsilon), end="\r")
-		# TODO end of temp
+		self.reporter.update(r=reward)
 
-		# Save the step into the memory
-		self.memory.store_entry(self.n_entries, screen_buf, action, reward)
+		# Save the step into the memory, in latent mode the encoding computed by advance
+		if self.memory.latent is not None:
+			self.memory.store_entry(self.n_entries, self.model.image_enc[0].numpy(), action,
+				reward)
+		else:
+			self.memory.store_entry(self.n_entries, None, action, reward)
 		self.n_entries += 1
 
 		done = game.is_episode_finished()
 		if done:
-			print("\nEpisode {} finished, average reward: {:10.3f}"
+			self.reporter.message("Episode {} finished, average reward: {:10.3f}"
 				.format(self.episode_id, self.reward_cum / self.n_entries))
 			
-			# overwrite last if minimum episode length was not reached
+			# underlength episodes are kept (the rest of the slot is masked out), but too many
+			# in a row means the current maps are too difficult
 			if self.n_entries < self.minimum_episode_length:
-				print("Episode underlength ({}), discarding...".format(self.n_entries))
-				self.n_discards += 1
-				return False
-			
-			self.episode_id += 1 # don't increase episode id after discarding
-			self.n_discards = 0
+				self.reporter.message("Episode underlength ({}), keeping it masked".format(
+					self.n_entries))
+				self.n_underlength += 1
+			else:
+				self.n_underlength = 0
+
+			self.episode_id += 1
 
 			# Sufficient number of entries gathered, time to train
 			if self.memory.finish_episode():
@@ -1,5 +1,6 @@
 from trainer_interface import *
 from utils import *
+from memory import mix_reward_simple
 import random
 import math
 
@@ -14,21 +15,24 @@ class TrainerSimple(TrainerInterface):
         r = random.random()
         if r < self.epsilon:
             if random.random() < 0.05:
-                action = get_random_action(turn_delta_sigma=5.0,
-                    weapon_switch_prob=0.3-0.26*self.epsilon)
+                action = self.action_noise.random_actions(1, turn_delta_sigma=5.0,
+                    weapon_switch_prob=0.3-0.26*self.epsilon)[0]
+                action[14] = 0.9*self.action_prev[14] + 0.1*action[14]
             else:
-                action = mutate_action(self.action_prev, 2, turn_delta_sigma=4.0, turn_damping=0.9,
-                    weapon_switch_prob=0.3-0.26*self.epsilon)
-            action[14] = 0.9*self.action_prev[14] + 0.1*action[14]
+                action = self.action_noise.mutate_actions(self.action_prev[None], 2,
+                    turn_delta_sigma=4.0, turn_damping=0.9,
+                    weapon_switch_prob=0.3-0.26*self.epsilon)[0]
         else:
-            action = self.model.predict_action(self.memory.active_episode)
+            action = self.predict_action()
 
             if r < self.epsilon*2.0:
-                action = mutate_action(action, 2, turn_delta_sigma=2.0, turn_damping=0.9,
-                    weapon_switch_prob=0.2-0.17*self.epsilon)
+                action = self.action_noise.mutate_actions(action[None], 2,
+                    turn_delta_sigma=2.0, turn_damping=0.9,
+                    weapon_switch_prob=0.2-0.17*self.epsilon)[0]
             elif r < self.epsilon*4.0:
-                action = mutate_action(action, 1, turn_delta_sigma=1.5, turn_damping=0.95,
-                    weapon_switch_prob=0.1-0.08*self.epsilon)
+                action = self.action_noise.mutate_actions(action[None], 1,
+                    turn_delta_sigma=1.5, turn_damping=0.95,
+                    weapon_switch_prob=0.1-0.08*self.epsilon)[0]
 
         # Add some random walk to epsilon
         # self.epsilon += np.random.normal(scale=1.0/128)
@@ -40,4 +44,4 @@ class TrainerSimple(TrainerInterface):
         return self.memory.sequence
 
     def mix_reward(self, reward_model, reward_game, reward_system):
-        return 10.0*reward_model + reward_game + reward_system
\ No newline at end of file
+        return mix_reward_simple(reward_model, reward_game, reward_system)
\ No newline at end of file
@@ -29,21 +29,42 @@ def print_state_objects(game):
         print("Object id:", o.id, "object name:", o.name)
         print("Object position: x:", o.position_x, ", y:", o.position_y, ", z:", o.position_z)
 
+"""
+convert a batch of actions (..., 15) to the mixed domain
+
+Buttons 0-13 become 1.0/0.0, the turning delta is scaled to game units. The result can be
+written into a preallocated out array.
+"""
+def convert_actions_to_mixed(actions_cont, out=None):
+    actions_cont = np.asarray(actions_cont)
+    if out is None:
+        out = np.empty(actions_cont.shape, dtype=np.float64)
+    np.greater(actions_cont, 0.0, out=out)
+    np.multiply(actions_cont[..., 14], 10.0, out=out[..., 14])
+    return out
+
+"""
+convert a batch of mixed domain actions (..., 15) back to the continuous domain
+"""
+def convert_actions_to_continuous(actions_mixed, out=None):
+    actions_mixed = np.asarray(actions_mixed, dtype=np.float64)
+    if out is None:
+        out = np.empty(actions_mixed.shape, dtype=np.float64)
+    np.subtract(actions_mixed != 0.0, 0.5, out=out)
+    np.divide(actions_mixed[..., 14], 10.0, out=out[..., 14])
+    return out
+
 """
 convert action to mixed domain (the one to be passed to game)
 """
 def convert_action_to_mixed(action_cont):
-    action_mixed = np.where(action_cont > 0.0, True, False).tolist()
-    action_mixed[14] = action_cont[14]*10.0
-    return action_mixed
+    return convert_actions_to_mixed(action_cont).tolist()
 
 """
 convert action to continuous domain
 """
 def convert_action_to_continuous(action_mixed):
-    action_cont = np.where(action_mixed, 0.5, -0.5)
-    action_cont[14] = action_mixed[14] / 10.0
-    return action_cont
+    return convert_actions_to_continuous(action_mixed)
 
 
 def get_random_action(turn_delta_sigma=3.3, weapon_switch_prob=0.05):
@@ -92,4 +113,116 @@ def mutate_action(action, max_flipped_buttons=4, turn_delta_sigma=1.0, turn_damp
     action[14] += random.gauss(0.0, turn_delta_sigma*0.1)
     action[14] = np.clip(action[14], -0.9, 0.9)
 
-    return np.asarray(action)
\ No newline at end of file
+    return np.asarray(action)
+
+class ActionNoise:
+    """
+    Vectorized counterpart of get_random_action and mutate_action
+
+    Works on batches of actions (one row per environment) and draws from its own seeded
+    numpy generator instead of the global python one.
+    """
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def get_state(self):
+        return self.rng.bit_generator.state
+
+    def set_state(self, state):
+        self.rng.bit_generator.state = state
+
+    def switch_weapons(self, actions, weapon_switch_prob):
+        n = actions.shape[0]
+        switch = self.rng.random(n) < weapon_switch_prob
+        weapon_ids = self.rng.integers(7, 14, n)
+        actions[switch, weapon_ids[switch]] = 0.9*self.rng.random(n)[switch]
+
+    """
+    ret: (n, 14) array of +-1, -1 for buttons flipped an odd number of times
+
+    Each environment flips 1...max_flipped_buttons buttons, picked with replacement.
+    """
+    def get_flip_signs(self, n, max_flipped_buttons):
+        n_flipped = self.rng.integers(1, max_flipped_buttons+1, n)
+        button_ids = self.rng.integers(0, 14, (n, max_flipped_buttons))
+        flipped = np.arange(max_flipped_buttons)[None,:] < n_flipped[:,None]
+
+        flip_counts = np.zeros((n, 14), dtype=int)
+        np.add.at(flip_counts, (np.repeat(np.arange(n), max_flipped_buttons), button_ids.ravel()),
+            flipped.ravel())
+        return np.where(flip_counts % 2 == 1, -1.0, 1.0)
+
+    """
+    ret: (n, 15) random actions, see get_random_action
+    """
+    def random_actions(self, n, turn_delta_sigma=3.3, weapon_switch_prob=0.05):
+        actions = np.empty((n, 15))
+        actions[:, 0:7] = -0.9 + 1.8*self.rng.random((n, 7))
+        actions[:, 5] = -0.9 + 1.35*self.rng.random(n) # weigh forward a bit more
+        actions[:, 6] = -0.45 + 1.35*self.rng.random(n)
+        actions[:, 7:14] = -0.9*self.rng.random((n, 7))
+
+        self.switch_weapons(actions, weapon_switch_prob)
+
+        # prevent simultaneous left/right or forward/back presses
+        for a, b in ((3, 4), (5, 6)):
+            both = (actions[:, a] > 0.0) & (actions[:, b] > 0.0)
+            flip_b = self.rng.random(n) < 0.5
+            actions[both & ~flip_b, a] *= -1.0
+            actions[both & flip_b, b] *= -1.0
+
+        actions[:, 14] = np.clip(self.rng.normal(0.0, turn_delta_sigma*0.1, n), -0.9, 0.9)
+        return actions
+
+    """
+    ret: (n, 15) mutated copy of the (n, 15) actions, see mutate_action
+    """
+    def mutate_actions(self, actions, max_flipped_buttons=4, turn_delta_sigma=1.0,
+        turn_damping=0.9, weapon_switch_prob=0.03):
+        actions = np.array(actions, dtype=np.float64)
+        n = actions.shape[0]
+
+        if max_flipped_buttons > 0:
+            actions[:, 0:14] *= self.get_flip_signs(n, max_flipped_buttons)
+
+        # reset weapon switching
+        actions[:, 7:14] = -0.9*self.rng.random((n, 7))
+        self.switch_weapons(actions, weapon_switch_prob)
+
+        # apply deviation to the turning delta
+        actions[:, 14] = np.clip(actions[:, 14]*turn_damping +
+            self.rng.normal(0.0, turn_delta_sigma*0.1, n), -0.9, 0.9)
+        return actions
+
+    """
+    Generate a whole episode of repeatedly mutated actions in advance
+
+    Equivalent to calling mutate_actions on the previous step's output length times.
+    ret: (length, n, 15)
+    """
+    def episode_actions(self, length, n, action_init=None, max_flipped_buttons=4,
+        turn_delta_sigma=1.0, turn_damping=0.9, weapon_switch_prob=0.03):
+        if action_init is None:
+            action_init = self.random_actions(n)
+
+        actions = np.empty((length, n, 15))
+
+        # flips accumulate, the sign of a button is the product of all flips so far
+        if max_flipped_buttons > 0:
+            signs = np.cumprod(self.get_flip_signs(length*n, max_flipped_buttons)
+                .reshape(length, n, 14), axis=0)
+            actions[:, :, 0:14] = action_init[None, :, 0:14]*signs
+        else:
+            actions[:, :, 0:14] = action_init[None, :, 0:14]
+
+        actions[:, :, 7:14] = -0.9*self.rng.random((length, n, 7))
+        self.switch_weapons(actions.reshape(length*n, 15), weapon_switch_prob)
+
+        # damped random walk of the turning delta, only this part is sequential
+        turn_noise = self.rng.normal(0.0, turn_delta_sigma*0.1, (length, n))
+        turn_delta = action_init[:, 14]
+        for i in range(length):
+            turn_delta = np.clip(turn_delta*turn_damping + turn_noise[i], -0.9, 0.9)
+            actions[i, :, 14] = turn_delta
+
+        return actions